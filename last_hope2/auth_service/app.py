@@ -1,22 +1,23 @@
-from flask import Flask
-from flask_sqlalchemy import SQLAlchemy
 from dotenv import load_dotenv
 import os
 from flask import Blueprint, request, jsonify
 from sqlalchemy.dialects.postgresql import JSON
-import redis
-from prometheus_client import start_http_server, Counter,generate_latest
+from prometheus_client import start_http_server, Counter
 from flask_cors import CORS
+from werkzeug.serving import is_running_from_reloader
 import logging
+import json
 
 load_dotenv()  # Load environment variables from .env
 
+from service_core import create_service_app, db, cache, bump_revision, start_warmup, indexed_filter_sets, requested_fields
+from service_core import etag_for, is_fresh, not_modified, with_etag
+
 # Create a metric to track time spent and requests made.
 #REQUEST_TIME = Summary('request_processing_seconds', 'Time spent processing request')
 request_couter = Counter('auth_requests', 'Number of requests')
 
-db = SQLAlchemy()
-cache = redis.Redis(host='redis', port=6379, db=0)  # Update host and port as necessary
+CACHE_TTL = int(os.getenv('CACHE_TTL', '300'))  # seconds
 
 # Define the User model
 class User(db.Model):
@@ -25,6 +26,7 @@ class User(db.Model):
     username = db.Column(db.String(50), nullable=False)
     email = db.Column(db.String(100), nullable=False, unique=True)
     password = db.Column(db.String(100), nullable=False)
+    revision = db.Column(db.Integer, nullable=False, default=1, server_default=db.text('1'))
 
     # Constructor (init method)
     def __init__(self, username, email, password):
@@ -42,6 +44,17 @@ class Character(db.Model):
     character_class = db.Column(db.String(50), nullable=False)
     character_race = db.Column(db.String(50), nullable=False)
     starting_stats = db.Column(JSON, nullable=False)
+    revision = db.Column(db.Integer, nullable=False, default=1, server_default=db.text('1'))
+    # varchar_pattern_ops lets Postgres use the name indexes for LIKE 'prefix%' lookups
+    __table_args__ = (
+        db.Index('ix_characters_user_id_class', 'user_id', 'character_class'),
+        db.Index('ix_characters_user_id_race', 'user_id', 'character_race'),
+        db.Index('ix_characters_user_id_name', 'user_id', 'character_name',
+                 postgresql_ops={'character_name': 'varchar_pattern_ops'}),
+        db.Index('ix_characters_race_class', 'character_race', 'character_class'),
+        db.Index('ix_characters_name', 'character_name',
+                 postgresql_ops={'character_name': 'varchar_pattern_ops'}),
+    )
 
     # Constructor (init method)
     def __init__(self, user_id, character_name, character_class, character_race, starting_stats):
@@ -53,15 +66,40 @@ class Character(db.Model):
 
     def __repr__(self):
         return f"<Character {self.title}>"
-    
+
+CHARACTER_FIELDS = ("id", "character_name", "user_id", "character_class", "character_race", "starting_stats")
+DEFAULT_CHARACTER_FIELDS = ("id", "character_name", "user_id", "character_class", "character_race")
+
+# Filter combinations /get_characters accepts. Each tuple lists the filters one index can
+# seek on, left to right, so any leading part of a tuple is a supported combination.
+CHARACTER_QUERY_INDEXES = [
+    ("user_id", "character_class"),
+    ("user_id", "character_race"),
+    ("user_id", "name_prefix"),
+    ("character_race", "character_class"),
+    ("name_prefix",),
+]
+
+CHARACTER_FILTER_SETS = indexed_filter_sets(CHARACTER_QUERY_INDEXES)
+
+# Cached entries keep the revision they were built from, so a cache hit can answer
+# conditional GETs without touching the database
+def load_cached(key):
+    cached = cache.get(key)
+    if not cached:
+        return None
+    try:
+        return json.loads(cached)
+    except ValueError:
+        return None  # Entry written in an older format, rebuild it
+
+def store_cached(key, revision, data):
+    # The TTL bounds how long an entry can outlive a delete that a down cache node missed
+    cache.set(key, json.dumps({"revision": revision, "data": data}), ex=CACHE_TTL)
+
 auth_routes = Blueprint('auth_routes', __name__)
 CORS(auth_routes) 
 
-# Prometheus endpoint for Prometheus to scrape metrics
-@auth_routes.route('/metrics')
-def metrics():
-    return generate_latest(), 200
-
 # Status endpoint
 @auth_routes.route('/status', methods=['GET'])
 def status():
@@ -181,15 +219,20 @@ def create_character():
 def get_user(user_id):
     request_couter.inc()
     # Check cache first
-    cached_user = cache.get(f"user:{user_id}")
+    cached_user = load_cached(f"user:{user_id}")
     if cached_user:
-        return jsonify(eval(cached_user)), 200  # Use eval to convert back to dict (caution with eval in production)
-    
-    
+        tag = etag_for("user", user_id, cached_user["revision"])
+        if is_fresh(tag):
+            return not_modified(tag)
+        return with_etag(jsonify(cached_user["data"]), tag), 200
 
     try:
         user = User.query.get(user_id)
         if user:
+            tag = etag_for("user", user.id, user.revision)
+            if is_fresh(tag):
+                return not_modified(tag)
+
             user_data = {
                 "user": {
                     "id": user.id,
@@ -199,8 +242,8 @@ def get_user(user_id):
                 "message": "User details retrieved successfully"
             }
             # Store user data in cache
-            cache.set(f"user:{user_id}", str(user_data))  # Convert to string for caching
-            return jsonify(user_data), 200
+            store_cached(f"user:{user_id}", user.revision, user_data)
+            return with_etag(jsonify(user_data), tag), 200
         else:
             return jsonify({"error": "User not found"}), 404
 
@@ -212,13 +255,20 @@ def get_user(user_id):
 def get_player_character(character_id):
     request_couter.inc()
     # Check cache first
-    cached_character = cache.get(f"character:{character_id}")
+    cached_character = load_cached(f"character:{character_id}")
     if cached_character:
-        return jsonify(eval(cached_character)), 200  # Use eval to convert back to dict (caution with eval in production)
+        tag = etag_for("character", character_id, cached_character["revision"])
+        if is_fresh(tag):
+            return not_modified(tag)
+        return with_etag(jsonify(cached_character["data"]), tag), 200
 
     try:
         character = Character.query.get(character_id)
         if character:
+            tag = etag_for("character", character.id, character.revision)
+            if is_fresh(tag):
+                return not_modified(tag)
+
             character_data = {
                 "character": {
                     "id": character.id,
@@ -230,25 +280,8 @@ def get_player_character(character_id):
                 "message": "Character details retrieved successfully"
             }
             # Store character data in cache
-            cache.set(f"character:{character_id}", str(character_data))  # Convert to string for caching
-            return jsonify(character_data), 200
-        else:
-            return jsonify({"error": "Character not found"}), 404
-
-    except Exception as e:
-        return jsonify({"error": str(e)}), 500
-    try:
-        character = Character.query.get(character_id)
-        if character:
-            return jsonify({
-                "character": {
-                    "id": character.id, 
-                    "character_name": character.character_name, 
-                    "character_class": character.character_class, 
-                    "character_race": character.character_race,
-                    "character_stats": character.starting_stats
-                }, 
-                "message": "Character details retrieved successfully"}), 200
+            store_cached(f"character:{character_id}", character.revision, character_data)
+            return with_etag(jsonify(character_data), tag), 200
         else:
             return jsonify({"error": "Character not found"}), 404
 
@@ -274,12 +307,40 @@ def get_users():
 @auth_routes.route('/get_characters', methods=['GET'])
 def get_characters():
     request_couter.inc()
+    filters = {}
+    if "user_id" in request.args:
+        filters["user_id"] = request.args.get("user_id", type=int)
+        if filters["user_id"] is None:
+            return jsonify({"error": "'user_id' must be an integer"}), 400
+    for name in ("character_class", "character_race", "name_prefix"):
+        if name in request.args:
+            filters[name] = request.args[name]
+    # An empty prefix would match every name, turning the index seek into a full scan
+    if filters.get("name_prefix") == "":
+        return jsonify({"error": "'name_prefix' must not be empty"}), 400
+
+    # Query-cost guard: only combinations served by an index are accepted
+    if filters and frozenset(filters) not in CHARACTER_FILTER_SETS:
+        supported = sorted(", ".join(sorted(combo)) for combo in CHARACTER_FILTER_SETS)
+        return jsonify({"error": "Unsupported filter combination", "supported_filters": supported}), 400
+
+    fields, error = requested_fields(CHARACTER_FIELDS, DEFAULT_CHARACTER_FIELDS)
+    if error:
+        return jsonify({"error": error}), 400
+
     try:
-        characters = Character.query.all()
+        query = db.session.query(*[getattr(Character, field) for field in fields])
+        if "user_id" in filters:
+            query = query.filter(Character.user_id == filters["user_id"])
+        if "character_class" in filters:
+            query = query.filter(Character.character_class == filters["character_class"])
+        if "character_race" in filters:
+            query = query.filter(Character.character_race == filters["character_race"])
+        if "name_prefix" in filters:
+            query = query.filter(Character.character_name.startswith(filters["name_prefix"], autoescape=True))
+
         return jsonify({
-            "characters": [
-                {"id": char.id, "character_name": char.character_name, "user_id":char.user_id ,"character_class": char.character_class, "character_race": char.character_race} for char in characters
-            ]
+            "characters": [dict(zip(fields, row)) for row in query.order_by(Character.id)]
         }), 200
 
     except Exception as e:
@@ -306,16 +367,16 @@ def transfer_character_ownership():
             return jsonify({"error": f"Character not found"}), 404
 
         character.user_id = new_user_id
+        bump_revision(Character, character_id)
         db.session.commit()
+        cache.delete(f"character:{character_id}")
 
         return jsonify({"message": "Character ownership updated"}), 200
 
     except Exception as e:
         print(f"Error occurred in auth_service: {e}")
-
-        character.player_id = old_user_id
-        db.session.commit()
-
+        # Nothing was committed, so rolling back restores the old owner and frees the connection
+        db.session.rollback()
 
         return jsonify({"error": "Failed to update character ownership", "details": str(e)}), 500
 
@@ -324,24 +385,7 @@ def transfer_character_ownership():
 
 
 def create_app():
-    app = Flask(__name__)
-
-    # Load configuration
-    app.config['SECRET_KEY'] = os.getenv('SECRET_KEY')
-    app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('DATABASE_URL')
-
-    # Initialize extensions
-    db.init_app(app)
-
-    # Register Blueprints
-    #from auth_service_routes import auth_routes
-    app.register_blueprint(auth_routes)
-
-    with app.app_context():
-        # Create the tables if they don't exist
-        db.create_all()
-
-    return app
+    return create_service_app(__name__, [auth_routes], admin_paths=['/delete_all_users'])
 
 # Create the app instance at the module level
 app = create_app()
@@ -349,8 +393,11 @@ app = create_app()
 
 
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=5000, debug=True)
+    debug = True
+    # With debug on, the reloader runs this file again in a child process and only that one serves requests
+    if not debug or is_running_from_reloader():
+        start_warmup(app)
+    app.run(host="0.0.0.0", port=5000, debug=debug)
 
     # Start a separate HTTP server for Prometheus metrics on port 8000
     start_http_server(8000)
-
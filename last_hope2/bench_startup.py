@@ -0,0 +1,73 @@
+"""Startup benchmark for a new session_service replica.
+
+Measures, in fresh interpreter processes:
+  * import   - time to import session_service/app.py (builds the app)
+  * ready    - import + warm-up until /ready answers 200
+  * serving  - ready + the first /get_sessions request
+
+    python bench_startup.py --runs 5
+
+Uses a throwaway SQLite file (migrated once up front) unless --database-url is given.
+Only the database check runs during warm-up unless --with-cache is passed.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SERVICE_DIR = os.path.join(HERE, 'session_service')
+
+CHILD = r"""
+import json, time
+start = time.perf_counter()
+import app as service
+imported = time.perf_counter()
+from service_core import start_warmup
+client = service.app.test_client()
+start_warmup(service.app)
+while client.get('/ready').status_code != 200:
+    time.sleep(0.005)
+ready = time.perf_counter()
+assert client.get('/get_sessions').status_code == 200
+serving = time.perf_counter()
+print(json.dumps({"import": imported - start, "ready": ready - start, "serving": serving - start}))
+"""
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--database-url')
+    parser.add_argument('--with-cache', action='store_true', help='also wait for Redis during warm-up')
+    args = parser.parse_args()
+
+    env = dict(os.environ)
+    env.update({
+        'PYTHONPATH': HERE,
+        'DATABASE_URL': args.database_url or f"sqlite:///{tempfile.mkdtemp()}/bench.db",
+        'READINESS_CHECKS': 'database,cache' if args.with_cache else 'database',
+        'ARCHIVE_ENABLED': 'false',
+        'RATE_LIMIT_ENABLED': 'false',
+    })
+
+    subprocess.run([sys.executable, '-m', 'flask', '--app', 'app', 'migrate'],
+                   cwd=SERVICE_DIR, env=env, check=True, capture_output=True)
+
+    samples = []
+    for _ in range(args.runs):
+        result = subprocess.run([sys.executable, '-c', CHILD], cwd=SERVICE_DIR, env=env,
+                                check=True, capture_output=True, text=True)
+        samples.append(json.loads(result.stdout.strip().splitlines()[-1]))
+
+    print(f"session_service startup over {args.runs} runs (seconds)")
+    for phase in ('import', 'ready', 'serving'):
+        values = [sample[phase] for sample in samples]
+        print(f"  {phase:<8} min {min(values):.3f}  median {statistics.median(values):.3f}  max {max(values):.3f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -34,6 +34,60 @@ function updateRequestCount(req,res,next){
     next();
   }
 
+// Headers the services use for admission control. The client IP comes from our own
+// socket, never from an incoming X-Forwarded-For, so callers can't pick their bucket;
+// the internal token tells the services that the forwarded IP can be trusted.
+function forwardHeaders(req) {
+    const headers = {
+        'X-Forwarded-For': req.socket.remoteAddress,
+        'X-Internal-Token': process.env.INTERNAL_SERVICE_TOKEN || '',
+    };
+    if (req.get('X-User-Id')) {
+        headers['X-User-Id'] = req.get('X-User-Id');
+    }
+    return headers;
+}
+
+// Headers for calls the gateway makes on its own behalf, such as the later steps of a saga.
+// Without X-Forwarded-For they use the services' internal budget, not the client's buckets,
+// so a client running low on tokens can't leave a saga half done.
+function internalHeaders() {
+    return {
+        'X-Internal-Token': process.env.INTERNAL_SERVICE_TOKEN || '',
+        'X-Internal-Service': 'gateway',
+    };
+}
+
+// Headers relayed as-is for conditional GETs, so clients keep the services' 304s and compression
+const CONDITIONAL_REQUEST_HEADERS = ['if-none-match', 'accept-encoding'];
+const CONDITIONAL_RESPONSE_HEADERS = ['etag', 'content-type', 'content-encoding', 'vary', 'retry-after'];
+
+// Proxy a GET without decoding the body: any status (including 304 and 503), the validators and the
+// still-compressed bytes go back to the client unchanged.
+async function relayConditionalGet(req, res, url) {
+    const headers = forwardHeaders(req);
+    for (const name of CONDITIONAL_REQUEST_HEADERS) {
+        if (req.get(name)) {
+            headers[name] = req.get(name);
+        }
+    }
+    const response = await axios.get(url, {
+        headers,
+        decompress: false,
+        responseType: 'arraybuffer',
+        validateStatus: () => true,  // 503s from warm-up, shedding or the pool carry Retry-After
+    });
+    for (const name of CONDITIONAL_RESPONSE_HEADERS) {
+        if (response.headers[name]) {
+            res.set(name, response.headers[name]);
+        }
+    }
+    if (response.status === 304) {
+        return res.status(304).end();
+    }
+    res.status(response.status).send(Buffer.from(response.data));
+}
+
 
 
 async function deregisterAllServices() {
@@ -216,7 +270,7 @@ app.post('/session/init',updateRequestCount, async (req, res) => {
                 }
 
                 // If service is up, attempt the actual service request
-                const response = await axios.post(`${seshServiceUrl}/session/init`, req.body, { timeout: 3000 });
+                const response = await axios.post(`${seshServiceUrl}/session/init`, req.body, { timeout: 3000, headers: forwardHeaders(req) });
                 return res.status(response.status).json(response.data); // Success: Return immediately
 
             } catch (error) {
@@ -244,7 +298,7 @@ app.post('/auth/register',updateRequestCount, async (req, res) => {
         const services = await consul.agent.service.list();
         const authServices = Object.values(services).filter(service => service.Service === 'auth_service');
         const authServiceUrl = `http://${authServices[0].Address}:${authServices[0].Port}`;
-        const response = await axios.post(`${authServiceUrl}/auth/register`, req.body, { timeout: 3000 });
+        const response = await axios.post(`${authServiceUrl}/auth/register`, req.body, { timeout: 3000, headers: forwardHeaders(req) });
         res.status(response.status).json(response.data);
     } catch (error) {
         if (error.code === 'ECONNABORTED') {
@@ -282,7 +336,7 @@ app.post('/session/:session_id/npc/create',updateRequestCount, async (req, res)
                 }
 
                 // If service is up, attempt the actual service request
-                const response = await axios.post(`${seshServiceUrl}/session/${sessionId}/npc/create`, req.body, { timeout: 3000 });
+                const response = await axios.post(`${seshServiceUrl}/session/${sessionId}/npc/create`, req.body, { timeout: 3000, headers: forwardHeaders(req) });
                 return res.status(response.status).json(response.data); // Success: Return immediately
 
             } catch (error) {
@@ -331,7 +385,7 @@ app.post('/session/:session_id/combat/initiate',updateRequestCount, async (req,
                 }
 
                 // If service is up, attempt the actual service request
-                const response = await axios.post(`${seshServiceUrl}/session/${sessionId}/combat/initiate`, req.body, { timeout: 3000 });
+                const response = await axios.post(`${seshServiceUrl}/session/${sessionId}/combat/initiate`, req.body, { timeout: 3000, headers: forwardHeaders(req) });
                 return res.status(response.status).json(response.data); // Success: Return immediately
 
             } catch (error) {
@@ -362,7 +416,7 @@ app.post('/auth',updateRequestCount, async (req, res) => {
         const services = await consul.agent.service.list();
         const authServices = Object.values(services).filter(service => service.Service === 'auth_service');
         const authServiceUrl = `http://${authServices[0].Address}:${authServices[0].Port}`;
-        const response = await axios.post(`${authServiceUrl}/auth`, req.body);
+        const response = await axios.post(`${authServiceUrl}/auth`, req.body, { headers: forwardHeaders(req) });
         res.status(response.status).json(response.data);
     } catch (error) {
         res.status(500).json({ message: 'Error authenticating user', error: error.message });
@@ -375,7 +429,7 @@ app.post('/auth/create-character',updateRequestCount, async (req, res) => {
         const services = await consul.agent.service.list();
         const authServices = Object.values(services).filter(service => service.Service === 'auth_service');
         const authServiceUrl = `http://${authServices[0].Address}:${authServices[0].Port}`;
-        const response = await axios.post(`${authServiceUrl}/auth/create-character`, req.body);
+        const response = await axios.post(`${authServiceUrl}/auth/create-character`, req.body, { headers: forwardHeaders(req) });
         res.status(response.status).json(response.data);
     } catch (error) {
         res.status(500).json({ message: 'Error creating character', error: error.message });
@@ -388,8 +442,7 @@ app.get('/auth/user/:userId',updateRequestCount, async (req, res) => {
         const services = await consul.agent.service.list();
         const authServices = Object.values(services).filter(service => service.Service === 'auth_service');
         const authServiceUrl = `http://${authServices[0].Address}:${authServices[0].Port}`;
-        const response = await axios.get(`${authServiceUrl}/auth/user/${req.params.userId}`);
-        res.status(response.status).json(response.data);
+        await relayConditionalGet(req, res, `${authServiceUrl}/auth/user/${req.params.userId}`);
     } catch (error) {
         res.status(500).json({ message: 'Error retrieving user details', error: error.message });
     }
@@ -401,8 +454,7 @@ app.get('/auth/character/:characterId',updateRequestCount, async (req, res) => {
         const services = await consul.agent.service.list();
         const authServices = Object.values(services).filter(service => service.Service === 'auth_service');
         const authServiceUrl = `http://${authServices[0].Address}:${authServices[0].Port}`;
-        const response = await axios.get(`${authServiceUrl}/auth/character/${req.params.characterId}`);
-        res.status(response.status).json(response.data);
+        await relayConditionalGet(req, res, `${authServiceUrl}/auth/character/${req.params.characterId}`);
     } catch (error) {
         res.status(500).json({ message: 'Error retrieving character details', error: error.message });
     }
@@ -432,7 +484,7 @@ app.get('/players/all', updateRequestCount, async (req, res) => {
                 }
 
                 // Fetch players if the service is up
-                const response = await axios.get(`${seshServiceUrl}/players/all`, { timeout: 3000 });
+                const response = await axios.get(`${seshServiceUrl}/players/all`, { timeout: 3000, headers: forwardHeaders(req) });
                 return res.status(response.status).json(response.data); // Return response on success
 
             } catch (error) {
@@ -457,6 +509,22 @@ app.get('/players/all', updateRequestCount, async (req, res) => {
 });
 
 
+// Reverse a session_service transfer after the auth_service step failed, retrying on the
+// same instance because that is where the transfer was made
+async function compensateSessionTransfer(seshServiceUrl, compensationPayload, maxRetries) {
+    for (let attempt = 1; attempt <= maxRetries; attempt++) {
+        try {
+            await axios.post(`${seshServiceUrl}/session/transfer-character`, compensationPayload,
+                { timeout: 3000, headers: internalHeaders() });
+            return true;
+        } catch (error) {
+            console.error(`Compensation attempt #${attempt} failed: ${error.message}`);
+        }
+    }
+    console.error(`Compensation failed, character ${compensationPayload.character_id} is owned by different players in the two services`);
+    return false;
+}
+
 app.post('/session/transfer-character', updateRequestCount, async (req, res) => {
     const maxRetries = 3;
     let sessionInstances = await consul.agent.service.list();
@@ -488,34 +556,57 @@ app.post('/session/transfer-character', updateRequestCount, async (req, res) =>
 
                 // Call session_service to transfer character
                 console.log("Calling session_service to transfer character...");
-                const seshResponse = await axios.post(`${seshServiceUrl}/session/transfer-character`, payload, { timeout: 3000 });
+                const seshResponse = await axios.post(`${seshServiceUrl}/session/transfer-character`, payload, { timeout: 3000, headers: forwardHeaders(req) });
 
                 if (seshResponse.status === 200) {
                     console.log("Session service transfer successful. Proceeding to auth_service...");
 
-                    // Call auth_service to transfer character ownership
-                    const authResponse = await axios.post(`http://auth_service:5000/auth/transfer-character`, payload, { timeout: 3000 });
+                    // From here on session_service has changed, so every outcome ends this request
+                    // and any failure, including a 429/503 or no answer at all, is compensated
+                    let authResponse = null;
+                    try {
+                        authResponse = await axios.post(`http://auth_service:5000/auth/transfer-character`, payload,
+                            { timeout: 3000, headers: internalHeaders(), validateStatus: () => true });
+                    } catch (authError) {
+                        console.error(`Auth service unreachable: ${authError.message}`);
+                    }
 
-                    if (authResponse.status === 200) {
+                    if (authResponse && authResponse.status === 200) {
                         console.log("Auth service transfer successful.");
                         return res.status(200).json({ message: 'Character transfer successful' });
-                    } else {
-                        console.error("Auth service transfer failed. Initiating compensation...");
-                        // Reverse the transfer in session_service
-                        const compensationPayload = { ...payload, new_player_id: old_player_id, old_player_id: new_player_id };
-                        await axios.post(`${seshServiceUrl}/session/transfer-character`, compensationPayload, { timeout: 3000 });
+                    }
 
+                    console.error("Auth service transfer failed. Initiating compensation...");
+                    // Reverse the transfer in session_service
+                    const compensationPayload = { ...payload, new_player_id: old_player_id, old_player_id: new_player_id };
+                    const compensated = await compensateSessionTransfer(seshServiceUrl, compensationPayload, maxRetries);
+                    if (!compensated) {
                         return res.status(500).json({
-                            error: "Auth service failed. Compensation completed in session_service.",
-                            details: authResponse.data,
+                            error: "Auth service failed and the session_service transfer could not be reversed.",
+                            details: authResponse ? authResponse.data : null,
                         });
                     }
+
+                    const busy = authResponse && [429, 503].includes(authResponse.status);
+                    if (busy) {
+                        res.set('Retry-After', authResponse.headers['retry-after'] || '1');
+                    }
+                    return res.status(busy ? 503 : 500).json({
+                        error: "Auth service failed. Compensation completed in session_service.",
+                        details: authResponse ? authResponse.data : null,
+                    });
                 }
             } catch (error) {
                 console.log(`Error on attempt #${attempt} with service URL: ${seshServiceUrl}`);
                 console.error(error);
                 lastError = error;
 
+                // The client is over its rate limit, retrying would only use up more of it
+                if (error.response && error.response.status === 429) {
+                    res.set('Retry-After', error.response.headers['retry-after'] || '1');
+                    return res.status(429).json(error.response.data);
+                }
+
                 if (attempt === maxRetries) {
                     console.log(`Instance ${seshServiceUrl} not working, checking next.`);
                 }
@@ -0,0 +1,124 @@
+"""Local stress test for the database pool, run against the real session_service app.
+
+Starts more concurrent requests to a session_service route than the pool can serve,
+with every query slowed down so each request holds its connection for a while, and
+reports what the callers saw: served requests, 503s from exhausted checkouts, the
+checkout wait times and whether every connection came back afterwards.
+
+    python pool_stress.py --workers 20 --pool-size 2 --overflow 1 --hold 1.5 --timeout 1
+    python pool_stress.py --route /players/all
+
+Uses a throwaway SQLite file unless --database-url points at a real database.
+Load shedding and rate limiting are off unless --shed is passed, so the pool itself
+is what runs out.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+parser.add_argument('--workers', type=int, default=20, help='concurrent requests')
+parser.add_argument('--route', default='/get_sessions', help='session_service route to request')
+parser.add_argument('--pool-size', type=int, default=2)
+parser.add_argument('--overflow', type=int, default=1)
+parser.add_argument('--timeout', type=int, default=1, help='whole seconds to wait for a connection')
+parser.add_argument('--hold', type=float, default=1.5, help='seconds added to the first query of each request')
+parser.add_argument('--shed', action='store_true', help='keep admission control on')
+parser.add_argument('--database-url')
+args = parser.parse_args()
+
+# The service reads its settings at import time
+os.environ.update({
+    'DATABASE_URL': args.database_url or f"sqlite:///{tempfile.mkdtemp()}/pool_stress.db",
+    'DB_POOL_SIZE': str(args.pool_size),
+    'DB_POOL_MAX_OVERFLOW': str(args.overflow),
+    'DB_POOL_TIMEOUT': str(args.timeout),
+    'READINESS_CHECKS': 'database',
+    'ARCHIVE_ENABLED': 'false',
+})
+if not args.shed:
+    os.environ.update({'RATE_LIMIT_ENABLED': 'false', 'SHED_POOL_UTILISATION': '1000', 'SHED_POOL_WAIT_MS': '1e9'})
+sys.path[:0] = [HERE, os.path.join(HERE, 'session_service')]
+
+from flask import g
+from sqlalchemy import event
+
+import app as service
+from service_core import run_migrations, start_warmup
+from service_core.dbpool import pool_wait_histogram
+
+
+def prepare(app, db):
+    with app.app_context():
+        run_migrations()
+        if not service.Session.query.first():
+            for i in range(20):
+                session = service.Session(gm_id=i % 4, campaign_name=f"Stress {i}")
+                db.session.add(session)
+                db.session.flush()
+                db.session.add(service.Player(session_id=session.id, player_id=100 + i, character_id=200 + i))
+            db.session.commit()
+
+        @event.listens_for(db.engine, 'before_cursor_execute')
+        def slow_query(conn, cursor, statement, parameters, context, executemany):
+            # Slow the first query of every request, while its connection is checked out
+            if not g.get('stress_slowed', True):
+                g.stress_slowed = True
+                time.sleep(args.hold)
+
+    @app.before_request
+    def mark_request():
+        g.stress_slowed = False
+
+    start_warmup(app)
+    while app.extensions['readiness'].state != 'ready':
+        time.sleep(0.01)
+
+
+def main():
+    app, db = service.app, service.db
+    prepare(app, db)
+    results = Counter()
+    latencies = []
+    lock = threading.Lock()
+
+    def worker():
+        client = app.test_client()
+        start = time.perf_counter()
+        status = client.get(args.route).status_code
+        with lock:
+            results[status] += 1
+            latencies.append(time.perf_counter() - start)
+
+    threads = [threading.Thread(target=worker) for _ in range(args.workers)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    with app.app_context():
+        checked_out = db.engine.pool.checkedout()
+
+    waits = {sample.labels.get('le'): sample.value for sample in pool_wait_histogram.collect()[0].samples
+             if sample.name.endswith('_bucket')}
+    latencies.sort()
+
+    print(f"GET {args.route}: pool capacity {args.pool_size} + {args.overflow} overflow, {args.workers} concurrent requests")
+    print(f"finished in {elapsed:.2f}s")
+    for status, count in sorted(results.items()):
+        print(f"  HTTP {status}: {count}")
+    print(f"latency p50 {latencies[len(latencies) // 2]:.3f}s, max {latencies[-1]:.3f}s")
+    print(f"checkout waits (cumulative per bucket): {waits}")
+    print(f"connections still checked out after the run: {checked_out}")
+
+
+if __name__ == '__main__':
+    main()
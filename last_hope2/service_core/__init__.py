@@ -0,0 +1,11 @@
+"""Code shared by the auth and session services: app factory, database pool,
+admission control, sharded Redis cache, readiness gate, migrations and HTTP caching."""
+from .admission import internal_headers
+from .cache_client import cache, get_cache, set_cache
+from .extensions import db, bump_revision
+from .factory import create_service_app
+from .http import etag_for, is_fresh, not_modified, with_etag
+from .migrate import run_migrations
+from .query import indexed_filter_sets, requested_fields
+from .readiness import on_ready, start_warmup
+from .sharding import HashRing, ShardedCache
@@ -0,0 +1,225 @@
+import hmac
+import math
+import os
+import threading
+
+from flask import request, jsonify, g
+from prometheus_client import Counter, Gauge
+import redis
+
+from .dbpool import recent_pool_wait
+
+# Admission control for the Flask services: per-client, per-user and per-route token
+# buckets kept in Redis (so every replica shares them), plus local load shedding when this
+# process is already saturated. Rate limited requests get 429, shed requests get 503,
+# both with Retry-After.
+#
+# Callers holding INTERNAL_SERVICE_TOKEN (the gateway and the services themselves) are
+# trusted to say who the client is through X-Forwarded-For. A trusted call without that
+# header is a service calling on its own behalf and gets its own, larger budget.
+
+RATE_LIMIT_ENABLED = os.getenv('RATE_LIMIT_ENABLED', 'true').lower() == 'true'
+USER_RATE = float(os.getenv('RATE_LIMIT_USER_RATE', '10'))  # tokens per second
+USER_BURST = int(os.getenv('RATE_LIMIT_USER_BURST', '20'))
+IP_RATE = float(os.getenv('RATE_LIMIT_IP_RATE', '50'))
+IP_BURST = int(os.getenv('RATE_LIMIT_IP_BURST', '100'))
+ROUTE_RATE = float(os.getenv('RATE_LIMIT_ROUTE_RATE', '200'))
+ROUTE_BURST = int(os.getenv('RATE_LIMIT_ROUTE_BURST', '400'))
+INTERNAL_RATE = float(os.getenv('RATE_LIMIT_INTERNAL_RATE', '100'))
+INTERNAL_BURST = int(os.getenv('RATE_LIMIT_INTERNAL_BURST', '200'))
+
+INTERNAL_SERVICE_TOKEN = os.getenv('INTERNAL_SERVICE_TOKEN', '')
+
+SHED_MAX_IN_FLIGHT = int(os.getenv('SHED_MAX_IN_FLIGHT', '64'))
+SHED_POOL_UTILISATION = float(os.getenv('SHED_POOL_UTILISATION', '1.0'))  # share of pool capacity checked out
+SHED_POOL_WAIT_MS = float(os.getenv('SHED_POOL_WAIT_MS', '250'))  # average connection checkout wait
+SHED_RETRY_AFTER = int(os.getenv('SHED_RETRY_AFTER', '1'))  # seconds
+
+EXEMPT_PATHS = {'/metrics', '/status', '/ready'}
+
+rejected_counter = Counter('admission_rejected_requests', 'Requests rejected by admission control', ['reason'])
+in_flight_gauge = Gauge('admission_in_flight_requests', 'Requests currently being processed')
+
+# Refills and charges every bucket in KEYS in one atomic step. ARGV holds a (rate, burst)
+# pair per key. A token is only taken when all buckets have one, otherwise the reply
+# carries how many milliseconds until the emptiest bucket refills.
+TOKEN_BUCKET_SCRIPT = """
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) * 1000 + math.floor(tonumber(clock[2]) / 1000)
+local levels = {}
+local wait = 0
+
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[2 * i - 1])
+    local burst = tonumber(ARGV[2 * i])
+    local state = redis.call('HMGET', key, 'tokens', 'ts')
+    local tokens = tonumber(state[1]) or burst
+    local ts = tonumber(state[2]) or now
+    tokens = math.min(burst, tokens + math.max(0, now - ts) * rate / 1000)
+    levels[i] = tokens
+    if tokens < 1 then
+        wait = math.max(wait, math.ceil((1 - tokens) * 1000 / rate))
+    end
+end
+
+local allowed = 0
+if wait == 0 then
+    allowed = 1
+end
+
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[2 * i - 1])
+    local burst = tonumber(ARGV[2 * i])
+    redis.call('HSET', key, 'tokens', tostring(levels[i] - allowed), 'ts', now)
+    redis.call('PEXPIRE', key, math.ceil(burst * 1000 / rate) + 1000)
+end
+
+return {allowed, wait}
+"""
+
+_in_flight = 0
+_in_flight_lock = threading.Lock()
+
+
+class LimiterState:
+    """Whether the rate limiter can reach Redis. Only changes are logged, not every failed request."""
+
+    def __init__(self):
+        self.up = True
+        self._lock = threading.Lock()
+
+    def mark_down(self, error):
+        with self._lock:
+            changed, self.up = self.up, False
+        if changed:
+            print(f"Rate limiter unavailable, letting requests through: {error}", flush=True)
+
+    def mark_up(self):
+        if self.up:
+            return
+        with self._lock:
+            changed, self.up = not self.up, True
+        if changed:
+            print("Rate limiter available again", flush=True)
+
+
+limiter_state = LimiterState()
+
+
+def internal_headers(service):
+    """Headers a service sends when it calls another service on its own behalf."""
+    return {'X-Internal-Token': INTERNAL_SERVICE_TOKEN, 'X-Internal-Service': service}
+
+
+def _trusted_caller():
+    token = request.headers.get('X-Internal-Token', '')
+    return bool(INTERNAL_SERVICE_TOKEN) and hmac.compare_digest(token, INTERNAL_SERVICE_TOKEN)
+
+
+def _claimed_user_id():
+    user_id = request.headers.get('X-User-Id') or request.args.get('user_id')
+    if not user_id:
+        body = request.get_json(silent=True) or {}
+        if isinstance(body, dict):
+            user_id = body.get('user_id') or body.get('gm_id')
+    return user_id
+
+
+def _rate_limit_buckets(route):
+    """(key, rate, burst) for every bucket the request has to take a token from."""
+    # Every key shares the {route} hash tag so the script finds them all on one cache node
+    prefix = f"ratelimit:{{{route}}}"
+    route_bucket = (f"{prefix}:all", ROUTE_RATE, ROUTE_BURST)
+
+    trusted = _trusted_caller()
+    forwarded = request.headers.get('X-Forwarded-For', '') if trusted else ''
+    if trusted and not forwarded:
+        service = request.headers.get('X-Internal-Service', 'internal')
+        return [(f"{prefix}:internal:{service}", INTERNAL_RATE, INTERNAL_BURST), route_bucket]
+
+    # Only a trusted proxy may name the client, anyone else is their own peer address
+    client_ip = forwarded.split(',')[0].strip() if forwarded else request.remote_addr
+    buckets = [(f"{prefix}:ip:{client_ip}", IP_RATE, IP_BURST)]
+
+    # The user id is only claimed by the client, so it is tied to the address it came
+    # from: a forged id cannot drain another user's bucket, and rotating ids still
+    # runs into the per-address bucket
+    user_id = _claimed_user_id()
+    if user_id:
+        buckets.append((f"{prefix}:user:{user_id}@{client_ip}", USER_RATE, USER_BURST))
+
+    buckets.append(route_bucket)
+    return buckets
+
+
+def _pool_congested(db):
+    try:
+        pool = db.engine.pool
+        if recent_pool_wait(pool) * 1000 >= SHED_POOL_WAIT_MS:
+            return True
+        capacity = pool.size() + max(getattr(pool, '_max_overflow', 0), 0)
+        return capacity > 0 and pool.checkedout() / capacity >= SHED_POOL_UTILISATION
+    except Exception:
+        return False
+
+
+def _reject(status, reason, retry_after, message):
+    rejected_counter.labels(reason=reason).inc()
+    response = jsonify({"error": message})
+    response.status_code = status
+    response.headers['Retry-After'] = str(retry_after)
+    return response
+
+
+def init_admission(app, cache, db):
+    # Registered on first use, against whichever client the cache resolves to then, so
+    # building the app doesn't create the client and a client set later is picked up
+    registered = {'client': None, 'script': None}
+
+    def token_bucket(keys, args):
+        client = cache._get_current_object() if hasattr(cache, '_get_current_object') else cache
+        if registered['client'] is not client:
+            registered['script'] = client.register_script(TOKEN_BUCKET_SCRIPT)
+            registered['client'] = client
+        return registered['script'](keys=keys, args=args)
+
+    @app.before_request
+    def admit_request():
+        global _in_flight
+        if request.path in EXEMPT_PATHS:
+            return None
+
+        # Load shedding: cheap local checks first, so an overloaded process sheds before doing any work
+        if _in_flight >= SHED_MAX_IN_FLIGHT:
+            return _reject(503, 'in_flight', SHED_RETRY_AFTER, "Service overloaded, try again later")
+        if _pool_congested(db):
+            return _reject(503, 'db_pool', SHED_RETRY_AFTER, "Service overloaded, try again later")
+
+        if RATE_LIMIT_ENABLED:
+            route = request.url_rule.rule if request.url_rule else request.path
+            buckets = _rate_limit_buckets(route)
+            keys = [key for key, _, _ in buckets]
+            args = [value for _, rate, burst in buckets for value in (rate, burst)]
+            try:
+                allowed, wait_ms = token_bucket(keys=keys, args=args)
+                limiter_state.mark_up()
+            except redis.exceptions.RedisError as e:
+                # Fail open: losing the limiter must not take the service down with it
+                limiter_state.mark_down(e)
+                allowed, wait_ms = 1, 0
+            if not allowed:
+                return _reject(429, 'rate_limit', max(1, math.ceil(wait_ms / 1000)), "Too many requests, try again later")
+
+        with _in_flight_lock:
+            _in_flight += 1
+        in_flight_gauge.inc()
+        g.admitted = True
+        return None
+
+    @app.teardown_request
+    def release_request(exc):
+        global _in_flight
+        if g.pop('admitted', False):
+            with _in_flight_lock:
+                _in_flight -= 1
+            in_flight_gauge.dec()
@@ -0,0 +1,49 @@
+import os
+
+import redis
+from werkzeug.local import LocalProxy
+
+from .sharding import ShardedCache
+
+# The cache client is only built the first time it is used, so importing a service
+# (for tests, migrations or the startup benchmark) never needs a live Redis.
+#
+# REDIS_NODES lists the shard primaries as host:port, REDIS_REPLICAS maps a primary to
+# its read replica as primary=replica pairs, both comma separated.
+#
+# The module is not called cache because the package exports the proxy under that name;
+# tests can swap the client with set_cache().
+
+REDIS_HOST = os.getenv('REDIS_HOST', 'redis')
+REDIS_PORT = int(os.getenv('REDIS_PORT', '6379'))
+REDIS_DB = int(os.getenv('REDIS_DB', '0'))
+REDIS_NODES = [node.strip() for node in os.getenv('REDIS_NODES', f"{REDIS_HOST}:{REDIS_PORT}").split(',') if node.strip()]
+REDIS_REPLICAS = dict(pair.strip().split('=', 1) for pair in os.getenv('REDIS_REPLICAS', '').split(',') if pair.strip())
+REDIS_VIRTUAL_NODES = int(os.getenv('REDIS_VIRTUAL_NODES', '160'))
+REDIS_DOWN_COOLDOWN = float(os.getenv('REDIS_DOWN_COOLDOWN', '5'))  # seconds a failed node is skipped
+REDIS_SOCKET_TIMEOUT = float(os.getenv('REDIS_SOCKET_TIMEOUT', '0.5'))
+
+_client = None
+
+
+def connect(address):
+    host, _, port = address.rpartition(':')
+    return redis.Redis(host=host, port=int(port), db=REDIS_DB,
+                       socket_connect_timeout=REDIS_SOCKET_TIMEOUT, socket_timeout=REDIS_SOCKET_TIMEOUT)
+
+
+def get_cache():
+    global _client
+    if _client is None:
+        _client = ShardedCache.from_addresses(REDIS_NODES, REDIS_REPLICAS, client_factory=connect,
+                                              virtual_nodes=REDIS_VIRTUAL_NODES, down_cooldown=REDIS_DOWN_COOLDOWN)
+    return _client
+
+
+def set_cache(client):
+    """Use client (e.g. a ShardedCache over fakeredis) instead of the configured nodes."""
+    global _client
+    _client = client
+
+
+cache = LocalProxy(get_cache)
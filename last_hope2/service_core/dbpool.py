@@ -0,0 +1,149 @@
+import os
+import time
+
+from flask import request, jsonify, g, has_request_context
+from prometheus_client import Counter, Gauge, Histogram
+from sqlalchemy import event
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.orm import Session as OrmSession
+from sqlalchemy.pool import QueuePool
+
+# Connection pool settings for the service database. Every connection gets a default
+# statement and idle-in-transaction timeout, and each request tightens the statement
+# timeout for its own transactions depending on its request class.
+
+POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '5'))
+POOL_MAX_OVERFLOW = int(os.getenv('DB_POOL_MAX_OVERFLOW', '10'))
+POOL_TIMEOUT = int(os.getenv('DB_POOL_TIMEOUT', '5'))  # whole seconds to wait for a free connection
+POOL_RECYCLE = int(os.getenv('DB_POOL_RECYCLE', '1800'))  # seconds before a connection is replaced
+POOL_PRE_PING = os.getenv('DB_POOL_PRE_PING', 'true').lower() == 'true'
+
+STATEMENT_TIMEOUT_MS = int(os.getenv('DB_STATEMENT_TIMEOUT_MS', '30000'))
+IDLE_IN_TRANSACTION_TIMEOUT_MS = int(os.getenv('DB_IDLE_IN_TRANSACTION_TIMEOUT_MS', '10000'))
+REQUEST_CLASS_TIMEOUTS_MS = {
+    'read': int(os.getenv('DB_READ_TIMEOUT_MS', '2000')),
+    'write': int(os.getenv('DB_WRITE_TIMEOUT_MS', '5000')),
+    'admin': int(os.getenv('DB_ADMIN_TIMEOUT_MS', str(STATEMENT_TIMEOUT_MS))),
+}
+
+# How long a slow checkout keeps counting as "the pool is congested"
+WAIT_SAMPLE_TTL = 5.0
+
+pool_wait_histogram = Histogram('db_pool_wait_seconds', 'Time spent waiting for a database connection',
+                                buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10))
+pool_timeout_counter = Counter('db_pool_timeouts', 'Requests that gave up waiting for a database connection')
+pool_size_gauge = Gauge('db_pool_size', 'Connections kept open in the pool')
+pool_checked_out_gauge = Gauge('db_pool_checked_out', 'Connections currently checked out of the pool')
+pool_overflow_gauge = Gauge('db_pool_overflow', 'Connections opened beyond the pool size')
+
+
+class TimedQueuePool(QueuePool):
+    """QueuePool that records how long each checkout waited for a connection."""
+
+    recent_wait = 0.0  # exponentially weighted average, in seconds
+    recent_wait_at = 0.0
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        except PoolTimeoutError:
+            pool_timeout_counter.inc()
+            if has_request_context():
+                g.pool_timed_out = True  # Routes may catch the error themselves, see init_pool
+            raise
+        finally:
+            waited = time.perf_counter() - start
+            pool_wait_histogram.observe(waited)
+            self.recent_wait = 0.8 * self.recent_wait + 0.2 * waited
+            self.recent_wait_at = time.monotonic()
+
+
+def recent_pool_wait(pool):
+    """Average checkout wait of the last few seconds, 0 when there is no fresh sample."""
+    if time.monotonic() - getattr(pool, 'recent_wait_at', 0.0) > WAIT_SAMPLE_TTL:
+        return 0.0
+    return getattr(pool, 'recent_wait', 0.0)
+
+
+def engine_options(database_uri):
+    if not database_uri or database_uri in ('sqlite://', 'sqlite:///:memory:'):
+        # In-memory SQLite has to stay on the single connection Flask-SQLAlchemy gives it
+        return {}
+
+    options = {
+        'poolclass': TimedQueuePool,
+        'pool_size': POOL_SIZE,
+        'max_overflow': POOL_MAX_OVERFLOW,
+        'pool_timeout': POOL_TIMEOUT,
+        'pool_recycle': POOL_RECYCLE,
+        'pool_pre_ping': POOL_PRE_PING,
+    }
+    if database_uri.startswith('postgresql'):
+        options['connect_args'] = {
+            'options': f"-c statement_timeout={STATEMENT_TIMEOUT_MS} "
+                       f"-c idle_in_transaction_session_timeout={IDLE_IN_TRANSACTION_TIMEOUT_MS}"
+        }
+    return options
+
+
+def request_class(admin_paths):
+    if request.path in admin_paths:
+        return 'admin'
+    if request.method in ('GET', 'HEAD', 'OPTIONS'):
+        return 'read'
+    return 'write'
+
+
+def init_pool(app, db, admin_paths=()):
+    """Call before db.init_app(app) so the engine is built with these options."""
+    app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', engine_options(app.config.get('SQLALCHEMY_DATABASE_URI')))
+    admin_paths = set(admin_paths)
+
+    @app.before_request
+    def set_request_class():
+        g.statement_timeout_ms = REQUEST_CLASS_TIMEOUTS_MS[request_class(admin_paths)]
+
+    @app.teardown_request
+    def release_connection(exc):
+        # Never hand a connection back in the middle of a failed transaction
+        if exc is not None:
+            db.session.rollback()
+        db.session.remove()
+
+    @app.errorhandler(PoolTimeoutError)
+    def pool_exhausted(e):
+        response = jsonify({"error": "Database busy, try again later"})
+        response.status_code = 503
+        response.headers['Retry-After'] = '1'
+        return response
+
+    @app.after_request
+    def answer_pool_timeouts(response):
+        # Routes that wrap their work in `except Exception` turn a checkout timeout into
+        # their own 500; the client should still learn that it can retry shortly
+        if g.pop('pool_timed_out', False) and response.status_code >= 500:
+            return pool_exhausted(None)
+        return response
+
+    @event.listens_for(OrmSession, 'after_begin')
+    def apply_statement_timeout(session, transaction, connection):
+        if connection.dialect.name != 'postgresql' or not has_request_context():
+            return
+        timeout = g.get('statement_timeout_ms')
+        if timeout:
+            # SET LOCAL only lasts for this transaction, the connection default comes back on commit
+            connection.exec_driver_sql(f"SET LOCAL statement_timeout = {int(timeout)}")
+
+    def pool_stat(name):
+        def read():
+            with app.app_context():
+                pool = db.engine.pool
+            stat = getattr(pool, name, None)
+            # QueuePool counts overflow from -pool_size, only report connections past the pool size
+            return max(stat(), 0) if callable(stat) else 0
+        return read
+
+    pool_size_gauge.set_function(pool_stat('size'))
+    pool_checked_out_gauge.set_function(pool_stat('checkedout'))
+    pool_overflow_gauge.set_function(pool_stat('overflow'))
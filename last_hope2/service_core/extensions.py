@@ -0,0 +1,9 @@
+from flask_sqlalchemy import SQLAlchemy
+
+# Shared by the models of whichever service imports it; bound to the app in create_service_app
+db = SQLAlchemy()
+
+
+def bump_revision(model, entity_id):
+    """Mark an entity as changed so its ETag changes. Call it before the route commits."""
+    model.query.filter_by(id=entity_id).update({model.revision: model.revision + 1}, synchronize_session=False)
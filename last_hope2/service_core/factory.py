@@ -0,0 +1,48 @@
+import os
+
+from flask import Flask, Blueprint
+from prometheus_client import generate_latest
+
+from .admission import init_admission
+from .cache_client import cache
+from .dbpool import init_pool
+from .extensions import db
+from .http import init_compression
+from .migrate import migrate_command
+from .readiness import init_readiness
+
+core_routes = Blueprint('core_routes', __name__)
+
+# Prometheus endpoint for Prometheus to scrape metrics
+@core_routes.route('/metrics')
+def metrics():
+    return generate_latest(), 200
+
+
+def create_service_app(import_name, blueprints, admin_paths=()):
+    """Build a service app without touching the database or Redis.
+
+    Tables are created by the `migrate` command and connections are opened by
+    start_warmup(), so this stays cheap enough to call at import time.
+    """
+    app = Flask(import_name)
+
+    # Load configuration
+    app.config['SECRET_KEY'] = os.getenv('SECRET_KEY')
+    app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('DATABASE_URL')
+
+    # Initialize extensions
+    init_pool(app, db, admin_paths)
+    db.init_app(app)
+    init_readiness(app, db)
+    init_admission(app, cache, db)
+    init_compression(app)
+
+    # Register Blueprints
+    app.register_blueprint(core_routes)
+    for blueprint in blueprints:
+        app.register_blueprint(blueprint)
+
+    app.cli.add_command(migrate_command)
+
+    return app
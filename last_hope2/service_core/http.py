@@ -0,0 +1,76 @@
+import gzip
+import os
+
+from flask import request, make_response
+from prometheus_client import Counter
+
+try:
+    import brotli
+except ImportError:  # brotli is optional, gzip is always available
+    brotli = None
+
+# Conditional GETs and response compression.
+#
+# ETags come from a per-entity revision counter that every mutating route bumps, so a
+# route can answer If-None-Match from the revision alone, without building the body.
+# They are weak ETags because the same revision may be sent gzip, brotli or plain.
+
+COMPRESS_MIN_SIZE = int(os.getenv('COMPRESS_MIN_SIZE', '1024'))  # bytes
+COMPRESS_LEVEL = int(os.getenv('COMPRESS_LEVEL', '6'))
+
+not_modified_counter = Counter('http_not_modified_responses', 'Conditional GETs answered with 304')
+compressed_bytes_counter = Counter('http_compressed_bytes', 'Response bytes before and after compression', ['stage'])
+
+
+def etag_for(kind, entity_id, revision):
+    return f"{kind}-{entity_id}-{revision}"
+
+
+def is_fresh(tag):
+    """True when the client's If-None-Match already names this ETag."""
+    return request.if_none_match.star_tag or request.if_none_match.contains_weak(tag)
+
+
+def not_modified(tag):
+    not_modified_counter.inc()
+    response = make_response('', 304)
+    response.set_etag(tag, weak=True)
+    return response
+
+
+def with_etag(response, tag):
+    response.set_etag(tag, weak=True)
+    return response
+
+
+def _pick_encoding():
+    if brotli is not None and request.accept_encodings.quality('br') > 0:
+        return 'br'
+    if request.accept_encodings.quality('gzip') > 0:
+        return 'gzip'
+    return None
+
+
+def init_compression(app):
+    @app.after_request
+    def compress_response(response):
+        if (response.status_code != 200 or response.direct_passthrough
+                or 'Content-Encoding' in response.headers):
+            return response
+
+        response.vary.add('Accept-Encoding')
+        body = response.get_data()
+        encoding = _pick_encoding()
+        if len(body) < COMPRESS_MIN_SIZE or encoding is None:
+            return response
+
+        if encoding == 'br':
+            compressed = brotli.compress(body, quality=min(COMPRESS_LEVEL, 11))
+        else:
+            compressed = gzip.compress(body, compresslevel=COMPRESS_LEVEL)
+        compressed_bytes_counter.labels(stage='original').inc(len(body))
+        compressed_bytes_counter.labels(stage='compressed').inc(len(compressed))
+
+        response.set_data(compressed)
+        response.headers['Content-Encoding'] = encoding
+        return response
@@ -0,0 +1,59 @@
+import os
+import time
+
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import inspect, text
+from sqlalchemy.exc import OperationalError
+
+from .extensions import db
+
+# One-shot schema step, run before the service replicas start:
+#     flask --app app migrate
+
+MIGRATE_RETRIES = int(os.getenv('MIGRATE_RETRIES', '30'))
+MIGRATE_RETRY_DELAY = float(os.getenv('MIGRATE_RETRY_DELAY', '2'))
+
+
+def run_migrations(retries=MIGRATE_RETRIES, delay=MIGRATE_RETRY_DELAY):
+    # The database container may still be starting up
+    for attempt in range(1, retries + 1):
+        try:
+            db.create_all()
+            break
+        except OperationalError as e:
+            if attempt == retries:
+                raise
+            print(f"Database not reachable yet ({attempt}/{retries}): {e}", flush=True)
+            time.sleep(delay)
+
+    # create_all skips tables that already exist, so add the columns and indexes
+    # that were introduced after those tables were created
+    inspector = inspect(db.engine)
+    with db.engine.begin() as connection:
+        for table in db.metadata.sorted_tables:
+            existing = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing:
+                    connection.execute(text(_add_column_sql(table, column)))
+
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(db.engine, checkfirst=True)
+
+
+def _add_column_sql(table, column):
+    sql = f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column.type.compile(db.engine.dialect)}"
+    if column.server_default is not None:
+        sql += f" DEFAULT {column.server_default.arg}"
+    if not column.nullable:
+        sql += " NOT NULL"
+    return sql
+
+
+@click.command('migrate')
+@with_appcontext
+def migrate_command():
+    """Create missing tables and indexes."""
+    run_migrations()
+    click.echo("Migrations applied")
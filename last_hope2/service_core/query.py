@@ -0,0 +1,22 @@
+from flask import request
+
+# Helpers for the filtered listing endpoints
+
+
+def indexed_filter_sets(indexes):
+    """Every filter combination an index can seek on: the leading columns of each index."""
+    return {frozenset(columns[:i]) for columns in indexes for i in range(1, len(columns) + 1)}
+
+
+def requested_fields(allowed, default=None):
+    """Parse the ?fields=a,b,c projection, falling back to the default fields."""
+    if "fields" not in request.args:
+        return list(default or allowed), None
+
+    fields = [field.strip() for field in request.args["fields"].split(",") if field.strip()]
+    if not fields:
+        return None, f"No fields requested. Supported fields: {', '.join(allowed)}"
+    unknown = [field for field in fields if field not in allowed]
+    if unknown:
+        return None, f"Unknown fields: {', '.join(unknown)}. Supported fields: {', '.join(allowed)}"
+    return fields, None
@@ -0,0 +1,115 @@
+import os
+import threading
+import time
+
+from flask import request, jsonify
+from prometheus_client import Gauge
+from sqlalchemy import text
+
+from .cache_client import get_cache
+
+# A replica warms up (database reachable, pool filled, cache reachable) before it takes
+# traffic. While warming, every route except the probes answers 503, and /ready only
+# turns 200 once warm-up has finished. Warm-up starts with start_warmup, or with the first
+# request the process receives, so it runs under any server.
+
+READINESS_CHECKS = [check.strip() for check in os.getenv('READINESS_CHECKS', 'database,cache').split(',') if check.strip()]
+WARMUP_RETRY_DELAY = float(os.getenv('WARMUP_RETRY_DELAY', '1'))  # seconds between failed warm-up attempts
+
+PROBE_PATHS = {'/ready', '/metrics', '/status'}
+
+ready_gauge = Gauge('service_ready', 'Whether the service has finished warming up')
+
+
+class Readiness:
+    def __init__(self):
+        self.state = 'idle'  # idle -> warming -> ready
+        self.started_at = None
+        self.warmup_seconds = None
+        self.callbacks = []
+        self.lock = threading.Lock()  # Guards state changes, so warm-up and each callback run once
+
+
+def _check_database(app, db):
+    with app.app_context():
+        pool = db.engine.pool
+        # Open the connections the pool keeps anyway, so the first requests don't pay for them
+        size = pool.size() if callable(getattr(pool, 'size', None)) else 1
+        connections = [db.engine.connect() for _ in range(max(size, 1))]
+        try:
+            connections[0].execute(text('SELECT 1'))
+        finally:
+            for connection in connections:
+                connection.close()
+
+
+def _check_cache(app, db):
+    get_cache().ping()
+
+
+CHECKS = {'database': _check_database, 'cache': _check_cache}
+
+
+def init_readiness(app, db):
+    readiness = app.extensions['readiness'] = Readiness()
+    app.extensions['readiness_db'] = db
+
+    @app.before_request
+    def readiness_gate():
+        if readiness.state == 'idle':
+            start_warmup(app)
+        if readiness.state == 'warming' and request.path not in PROBE_PATHS:
+            response = jsonify({"error": "Service is starting, try again later"})
+            response.status_code = 503
+            response.headers['Retry-After'] = '1'
+            return response
+        return None
+
+    @app.route('/ready', methods=['GET'])
+    def ready():
+        if readiness.state == 'ready':
+            return jsonify({"status": "ready", "warmup_seconds": readiness.warmup_seconds}), 200
+        return jsonify({"status": readiness.state}), 503
+
+
+def on_ready(app, callback):
+    """Run callback(app) once the service is warm, e.g. to start background jobs."""
+    readiness = app.extensions['readiness']
+    with readiness.lock:
+        if readiness.state != 'ready':
+            readiness.callbacks.append(callback)
+            return
+    callback(app)
+
+
+def start_warmup(app):
+    readiness = app.extensions['readiness']
+    db = app.extensions['readiness_db']
+    with readiness.lock:
+        if readiness.state != 'idle':
+            return None
+        readiness.state = 'warming'
+        readiness.started_at = time.perf_counter()
+
+    def run():
+        for name in READINESS_CHECKS:
+            while True:
+                try:
+                    CHECKS[name](app, db)
+                    break
+                except Exception as e:
+                    print(f"Warm-up check '{name}' failed, retrying: {e}", flush=True)
+                    time.sleep(WARMUP_RETRY_DELAY)
+
+        with readiness.lock:
+            readiness.warmup_seconds = round(time.perf_counter() - readiness.started_at, 3)
+            readiness.state = 'ready'
+            callbacks, readiness.callbacks = readiness.callbacks, []
+        ready_gauge.set(1)
+        print(f"Service ready after {readiness.warmup_seconds}s", flush=True)
+        for callback in callbacks:
+            callback(app)
+
+    thread = threading.Thread(target=run, name="warmup", daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,257 @@
+import bisect
+import hashlib
+import time
+
+from prometheus_client import Counter, Gauge
+import redis
+
+# Client-side sharding of the cache over several Redis nodes.
+#
+# Keys are placed on a consistent-hash ring where every node owns many virtual points,
+# so adding or removing a node only moves the keys next to its points (about 1/N of
+# them); those keys simply miss once and are rebuilt. As in Redis Cluster, only the part
+# of a key inside {braces} is hashed, which keeps keys that a script touches together
+# on the same node.
+#
+# A node that fails is skipped for a cool-down period. Reads then go to its replica if
+# it has one, otherwise they miss; writes are dropped. The cache is never the reason a
+# request fails.
+
+shard_requests_counter = Counter('cache_shard_requests', 'Cache commands sent to each shard', ['shard', 'op'])
+shard_hits_counter = Counter('cache_shard_hits', 'Cache reads that found a value', ['shard'])
+shard_misses_counter = Counter('cache_shard_misses', 'Cache reads that found nothing', ['shard'])
+shard_errors_counter = Counter('cache_shard_errors', 'Cache commands that failed on a node', ['shard', 'role'])
+shard_up_gauge = Gauge('cache_shard_up', 'Whether the shard primary is currently used', ['shard'])
+
+NODE_ERRORS = (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError)
+
+
+def hash_slot_key(key):
+    """The part of a key that decides its node: the first non-empty {tag}, else the whole key."""
+    if isinstance(key, bytes):
+        key = key.decode()
+    start = key.find('{')
+    if start != -1:
+        end = key.find('}', start + 1)
+        if end > start + 1:
+            return key[start + 1:end]
+    return key
+
+
+def _hash(value):
+    return int.from_bytes(hashlib.md5(value.encode()).digest()[:8], 'big')
+
+
+class HashRing:
+    def __init__(self, virtual_nodes=160):
+        self.virtual_nodes = virtual_nodes
+        self._points = []  # sorted hashes
+        self._owners = {}  # hash -> node name
+
+    def add_node(self, name):
+        for i in range(self.virtual_nodes):
+            point = _hash(f"{name}#{i}")
+            if point not in self._owners:
+                bisect.insort(self._points, point)
+                self._owners[point] = name
+
+    def remove_node(self, name):
+        self._points = [point for point in self._points if self._owners[point] != name]
+        self._owners = {point: owner for point, owner in self._owners.items() if owner != name}
+
+    def get_node(self, key):
+        if not self._points:
+            return None
+        index = bisect.bisect(self._points, _hash(hash_slot_key(key))) % len(self._points)
+        return self._owners[self._points[index]]
+
+
+class Shard:
+    def __init__(self, name, primary, replica=None):
+        self.name = name
+        self.primary = primary
+        self.replica = replica
+        self.down_until = 0.0
+        self.up = True
+        shard_up_gauge.labels(shard=name).set(1)
+
+    @property
+    def available(self):
+        return time.monotonic() >= self.down_until
+
+    def mark_down(self, cooldown):
+        self.down_until = time.monotonic() + cooldown
+        self.up = False
+        shard_up_gauge.labels(shard=self.name).set(0)
+
+    def mark_up(self):
+        self.down_until = 0.0
+        if not self.up:
+            self.up = True
+            shard_up_gauge.labels(shard=self.name).set(1)
+
+
+class ShardedCache:
+    """Subset of the redis.Redis API, spread over a ring of nodes.
+
+    `nodes` maps a node name to its client and `replicas` maps a node name to the
+    client of its read replica. Any object with the redis-py interface works as a
+    client, so tests can pass in-memory stand-ins such as fakeredis.
+    """
+
+    def __init__(self, nodes, replicas=None, virtual_nodes=160, down_cooldown=5.0):
+        self.ring = HashRing(virtual_nodes)
+        self.shards = {}
+        self.down_cooldown = down_cooldown
+        replicas = replicas or {}
+        for name, client in nodes.items():
+            self.add_node(name, client, replicas.get(name))
+
+    @classmethod
+    def from_addresses(cls, nodes, replicas, client_factory, **kwargs):
+        """Build from node addresses; replicas maps a node address to its replica address."""
+        return cls({address: client_factory(address) for address in nodes},
+                   {address: client_factory(replica) for address, replica in replicas.items()},
+                   **kwargs)
+
+    # Ring membership
+
+    def add_node(self, name, client, replica=None):
+        self.shards[name] = Shard(name, client, replica)
+        self.ring.add_node(name)
+
+    def remove_node(self, name):
+        self.ring.remove_node(name)
+        self.shards.pop(name, None)
+
+    def shard_for(self, key):
+        name = self.ring.get_node(key)
+        return self.shards[name] if name else None
+
+    # Command routing
+
+    def _run(self, shard, op, command, read=False):
+        """Run command(client) on the shard primary, falling back to the replica for reads.
+
+        Raises NodeUnavailable when neither can serve it."""
+        shard_requests_counter.labels(shard=shard.name, op=op).inc()
+        if shard.available:
+            try:
+                result = command(shard.primary)
+                shard.mark_up()
+                return result
+            except NODE_ERRORS as e:
+                shard_errors_counter.labels(shard=shard.name, role='primary').inc()
+                shard.mark_down(self.down_cooldown)
+                print(f"Cache node {shard.name} unavailable: {e}", flush=True)
+
+        if read and shard.replica is not None:
+            try:
+                return command(shard.replica)
+            except NODE_ERRORS:
+                shard_errors_counter.labels(shard=shard.name, role='replica').inc()
+        raise NodeUnavailable(shard.name)
+
+    def _record_read(self, shard, value):
+        if value is None:
+            shard_misses_counter.labels(shard=shard.name).inc()
+        else:
+            shard_hits_counter.labels(shard=shard.name).inc()
+
+    def get(self, key):
+        shard = self.shard_for(key)
+        if shard is None:
+            return None
+        try:
+            value = self._run(shard, 'get', lambda client: client.get(key), read=True)
+        except NodeUnavailable:
+            value = None  # Bypass the cache
+        self._record_read(shard, value)
+        return value
+
+    def set(self, key, value, **kwargs):
+        shard = self.shard_for(key)
+        if shard is None:
+            return None
+        try:
+            return self._run(shard, 'set', lambda client: client.set(key, value, **kwargs))
+        except NodeUnavailable:
+            return None
+
+    def delete(self, *keys):
+        deleted = 0
+        for shard, shard_keys in self._group(keys).items():
+            try:
+                deleted += self._run(shard, 'delete', lambda client: client.delete(*shard_keys))
+            except NodeUnavailable:
+                # The entry survives until it expires, so cached entries should carry a TTL
+                pass
+        return deleted
+
+    def mget(self, keys):
+        """Values for keys in order, with one pipelined round trip per shard."""
+        keys = list(keys)
+        values = {}
+        for shard, shard_keys in self._group(keys).items():
+            def fetch(client):
+                pipe = client.pipeline(transaction=False)
+                for key in shard_keys:
+                    pipe.get(key)
+                return pipe.execute()
+            try:
+                results = self._run(shard, 'mget', fetch, read=True)
+            except NodeUnavailable:
+                results = [None] * len(shard_keys)
+            for key, value in zip(shard_keys, results):
+                self._record_read(shard, value)
+                values[key] = value
+        return [values[key] for key in keys]
+
+    def ping(self):
+        """Check every node; fails only when no node at all can be reached."""
+        reachable = 0
+        for shard in list(self.shards.values()):
+            shard.down_until = 0.0  # Probe even nodes that are cooling down
+            try:
+                self._run(shard, 'ping', lambda client: client.ping(), read=True)
+                reachable += 1
+            except NodeUnavailable:
+                pass
+        if self.shards and not reachable:
+            raise redis.exceptions.ConnectionError("No cache node is reachable")
+        return True
+
+    def register_script(self, script):
+        return ShardedScript(self, script)
+
+    def _group(self, keys):
+        groups = {}
+        for key in keys:
+            shard = self.shard_for(key)
+            if shard is not None:
+                groups.setdefault(shard, []).append(key)
+        return groups
+
+
+class NodeUnavailable(redis.exceptions.ConnectionError):
+    pass
+
+
+class ShardedScript:
+    """Lua script run on the node that owns its first key. Every key passed to one
+    call must share a {hash tag} so they all live on that node."""
+
+    def __init__(self, cache, script):
+        self.cache = cache
+        self.script = script
+        self._scripts = {}  # node name -> redis-py Script
+
+    def __call__(self, keys, args=()):
+        shard = self.cache.shard_for(keys[0])
+        if shard is None:
+            raise NodeUnavailable("no cache nodes configured")
+        if shard.name not in self._scripts:
+            self._scripts[shard.name] = shard.primary.register_script(self.script)
+        script = self._scripts[shard.name]
+        # Scripts write, so they never run on a replica
+        return self.cache._run(shard, 'script', lambda client: script(keys=keys, args=args, client=client))
@@ -0,0 +1,63 @@
+import importlib.util
+import os
+
+import fakeredis
+import pytest
+
+# The services read their settings at import time
+os.environ.update({
+    'DATABASE_URL': 'sqlite://',
+    'READINESS_CHECKS': '',
+    'ARCHIVE_ENABLED': 'false',
+    'RATE_LIMIT_ENABLED': 'false',
+})
+
+from service_core import db, set_cache  # noqa: E402
+from service_core.sharding import ShardedCache  # noqa: E402
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def load_service(name):
+    """Import <name>/app.py; both services call their module app, so each gets its own name."""
+    spec = importlib.util.spec_from_file_location(f"{name}_app", os.path.join(ROOT, name, 'app.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.fixture(scope='session')
+def session_service():
+    return load_service('session_service')
+
+
+@pytest.fixture(scope='session')
+def auth_service():
+    return load_service('auth_service')
+
+
+@pytest.fixture
+def cache():
+    cache = ShardedCache({'redis:6379': fakeredis.FakeRedis(server=fakeredis.FakeServer())})
+    set_cache(cache)
+    yield cache
+    set_cache(None)
+
+
+def _client(service, cache):
+    app = service.app
+    app.extensions['readiness'].state = 'ready'
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+    return app.test_client()
+
+
+@pytest.fixture
+def session_client(session_service, cache):
+    return _client(session_service, cache)
+
+
+@pytest.fixture
+def auth_client(auth_service, cache):
+    return _client(auth_service, cache)
@@ -0,0 +1,140 @@
+import time
+from types import SimpleNamespace
+
+import fakeredis
+from flask import Flask
+import pytest
+
+from service_core import admission
+from service_core.admission import TOKEN_BUCKET_SCRIPT, init_admission
+from service_core.sharding import ShardedCache
+
+
+class FakePool:
+    """What load shedding reads from a TimedQueuePool."""
+
+    def __init__(self, size=2, max_overflow=0):
+        self._size = size
+        self._max_overflow = max_overflow
+        self.checked_out = 0
+        self.recent_wait = 0.0
+        self.recent_wait_at = 0.0
+
+    def size(self):
+        return self._size
+
+    def checkedout(self):
+        return self.checked_out
+
+
+@pytest.fixture
+def server():
+    return fakeredis.FakeServer()
+
+
+@pytest.fixture
+def cache(server):
+    # No cooldown, so a node that comes back is used by the next request
+    return ShardedCache({'redis:6379': fakeredis.FakeRedis(server=server)}, down_cooldown=0)
+
+
+@pytest.fixture
+def pool():
+    return FakePool()
+
+
+@pytest.fixture
+def client(monkeypatch, cache, pool):
+    monkeypatch.setattr(admission, 'RATE_LIMIT_ENABLED', True)
+    monkeypatch.setattr(admission, 'IP_BURST', 3)
+    monkeypatch.setattr(admission, 'IP_RATE', 0.01)
+    monkeypatch.setattr(admission, '_in_flight', 0)
+    monkeypatch.setattr(admission, 'limiter_state', admission.LimiterState())
+    app = Flask(__name__)
+    init_admission(app, cache, SimpleNamespace(engine=SimpleNamespace(pool=pool)))
+
+    @app.route('/things')
+    def things():
+        return 'ok'
+
+    return app.test_client()
+
+
+def test_bucket_empties_after_the_burst_and_refills(cache):
+    bucket = cache.register_script(TOKEN_BUCKET_SCRIPT)
+    keys, args = ['ratelimit:{/things}:ip:1.2.3.4'], [20, 3]  # 20 tokens per second, burst of 3
+
+    assert [bucket(keys=keys, args=args)[0] for _ in range(3)] == [1, 1, 1]
+    allowed, wait_ms = bucket(keys=keys, args=args)
+    assert allowed == 0
+    assert 0 < wait_ms <= 50  # One token takes 50ms at 20 per second
+
+    time.sleep(0.1)
+    assert bucket(keys=keys, args=args)[0] == 1
+
+
+def test_buckets_are_only_charged_together(cache, server):
+    bucket = cache.register_script(TOKEN_BUCKET_SCRIPT)
+    keys = ['ratelimit:{/things}:user:7@1.2.3.4', 'ratelimit:{/things}:all']
+    args = [0.001, 1, 0.001, 5]  # The user bucket holds one token, the route bucket five
+
+    assert bucket(keys=keys, args=args)[0] == 1
+    assert bucket(keys=keys, args=args)[0] == 0
+
+    # The refused call took nothing from the route bucket, although it had tokens left
+    route_tokens = float(fakeredis.FakeRedis(server=server).hget(keys[1], 'tokens'))
+    assert route_tokens == pytest.approx(4, abs=0.01)
+
+
+def test_rate_limited_requests_get_429_with_retry_after(client):
+    statuses = [client.get('/things').status_code for _ in range(4)]
+
+    assert statuses == [200, 200, 200, 429]
+    response = client.get('/things')
+    assert response.status_code == 429
+    assert int(response.headers['Retry-After']) >= 1
+
+
+def test_clients_have_separate_buckets(client):
+    for _ in range(3):
+        client.get('/things', environ_base={'REMOTE_ADDR': '10.0.0.1'})
+    assert client.get('/things', environ_base={'REMOTE_ADDR': '10.0.0.1'}).status_code == 429
+    assert client.get('/things', environ_base={'REMOTE_ADDR': '10.0.0.2'}).status_code == 200
+
+
+def test_limiter_fails_open_when_redis_is_down(client, server, capsys):
+    server.connected = False
+
+    assert [client.get('/things').status_code for _ in range(5)] == [200] * 5
+    server.connected = True
+    client.get('/things')
+
+    # One line when the limiter is lost and one when it is back, not one per request
+    log = capsys.readouterr().out
+    assert log.count("Rate limiter unavailable") == 1
+    assert log.count("Rate limiter available again") == 1
+
+
+def test_sheds_when_too_many_requests_are_in_flight(client, monkeypatch):
+    monkeypatch.setattr(admission, '_in_flight', admission.SHED_MAX_IN_FLIGHT)
+
+    response = client.get('/things')
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == str(admission.SHED_RETRY_AFTER)
+
+
+def test_sheds_when_the_pool_is_fully_checked_out(client, pool):
+    pool.checked_out = pool.size()
+    assert client.get('/things').status_code == 503
+
+    pool.checked_out = 0
+    pool.recent_wait, pool.recent_wait_at = 1.0, time.monotonic()  # Slow checkouts just now
+    assert client.get('/things').status_code == 503
+
+    pool.recent_wait = 0.0
+    assert client.get('/things').status_code == 200
+
+
+def test_probe_paths_are_never_rejected(client, pool):
+    pool.checked_out = pool.size()
+    assert client.get('/metrics').status_code == 404  # Reached routing, not shed
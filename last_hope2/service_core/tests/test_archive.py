@@ -0,0 +1,88 @@
+import pytest
+
+from service_core import db
+
+
+def add_session(service, gm_id, status, players=()):
+    session = service.Session(gm_id=gm_id, campaign_name=f"Campaign of {gm_id}", status=status)
+    db.session.add(session)
+    db.session.flush()
+    for player_id, character_id in players:
+        db.session.add(service.Player(session_id=session.id, player_id=player_id, character_id=character_id))
+    db.session.add(service.NPC(session_id=session.id, npc_name="Goblin", npc_stats={"hp": 7}, npc_role="enemy"))
+    db.session.add(service.Combat(session_id=session.id, participants=[player_id for player_id, _ in players]))
+    return session
+
+
+@pytest.fixture
+def sessions(session_service, session_client):
+    """Five ended sessions and two active ones, alternating between GMs 1 and 2."""
+    with session_service.app.app_context():
+        statuses = ['ended', 'active', 'ended', 'ended', 'active', 'ended', 'ended']
+        ids = {}
+        for i, status in enumerate(statuses):
+            session = add_session(session_service, gm_id=1 + i % 2, status=status, players=[(100 + i, 200 + i)])
+            ids.setdefault(status, []).append(session.id)
+        db.session.commit()
+    return ids
+
+
+@pytest.mark.parametrize('batch_size, pause_count', [(2, 2), (5, 1), (10, 0)])
+def test_archives_every_ended_session_in_batches(session_service, sessions, monkeypatch, batch_size, pause_count):
+    pauses = []
+    monkeypatch.setattr(session_service.time, 'sleep', pauses.append)
+
+    with session_service.app.app_context():
+        assert session_service.archive_ended_sessions(batch_size=batch_size, pause=0.25) == 5
+        assert session_service.archive_ended_sessions(batch_size=batch_size, pause=0.25) == 0
+
+        archived_ids = sorted(archived.id for archived in session_service.ArchivedSession.query)
+        assert archived_ids == sessions['ended']
+    # A full batch may be followed by more, so the job pauses after each one
+    assert pauses == [0.25] * pause_count
+
+
+def test_moves_child_rows_and_keeps_active_sessions(session_service, sessions):
+    with session_service.app.app_context():
+        ended_id = sessions['ended'][0]
+        expected = session_service.serialize_session(db.session.get(session_service.Session, ended_id))
+
+        session_service.archive_ended_sessions(batch_size=2, pause=0)
+
+        assert sorted(session.id for session in session_service.Session.query) == sessions['active']
+        for model in (session_service.Player, session_service.NPC, session_service.Combat):
+            assert sorted({row.session_id for row in model.query}) == sessions['active']
+        assert db.session.get(session_service.ArchivedSession, ended_id).to_dict() == expected
+
+
+def test_get_session_falls_back_to_the_archive(session_service, session_client, sessions):
+    ended_id = sessions['ended'][0]
+    live = session_client.get(f'/get_session/{ended_id}')
+    with session_service.app.app_context():
+        session_service.archive_ended_sessions(batch_size=2, pause=0)
+
+    response = session_client.get(f'/get_session/{ended_id}')
+    assert response.status_code == 200
+    assert response.get_json() == dict(live.get_json(), archived=True)
+    assert response.headers['ETag'] == f'W/"session-{ended_id}-archived"'
+
+    cached = session_client.get(f'/get_session/{ended_id}', headers={'If-None-Match': response.headers['ETag']})
+    assert cached.status_code == 304
+    assert session_client.get('/get_session/999').status_code == 404
+
+
+def test_get_sessions_by_gm_merges_live_and_archived(session_service, session_client, sessions):
+    with session_service.app.app_context():
+        session_service.archive_ended_sessions(batch_size=2, pause=0)
+
+    gm_sessions = session_client.get('/get_sessions?gm_id=1').get_json()
+    assert [session['session_id'] for session in gm_sessions] == [1, 3, 5, 7]
+    assert [session.get('archived', False) for session in gm_sessions] == [True, True, False, True]
+    assert gm_sessions[0]['players'] == [{'player_id': 100, 'character_id': 200}]
+
+    ended = session_client.get('/get_sessions?gm_id=2&status=ended&fields=session_id,status').get_json()
+    assert ended == [{'session_id': 4, 'status': 'ended', 'archived': True},
+                     {'session_id': 6, 'status': 'ended', 'archived': True}]
+
+    active = session_client.get('/get_sessions?gm_id=1&status=active').get_json()
+    assert [session['session_id'] for session in active] == [5]
@@ -0,0 +1,66 @@
+from flask import Flask, jsonify
+from flask_sqlalchemy import SQLAlchemy
+import pytest
+from sqlalchemy import text
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import QueuePool
+
+from service_core.dbpool import init_pool
+
+
+@pytest.fixture
+def client(tmp_path):
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = f"sqlite:///{tmp_path}/pool.db"
+    db = SQLAlchemy()
+    init_pool(app, db)
+    db.init_app(app)
+
+    @app.route('/catches')
+    def catches():
+        try:
+            db.session.execute(text('SELECT 1'))
+            return jsonify({"message": "ok"}), 200
+        except Exception as e:
+            return jsonify({"error": str(e)}), 500
+
+    @app.route('/raises')
+    def raises():
+        db.session.execute(text('SELECT 1'))
+        return jsonify({"message": "ok"}), 200
+
+    @app.route('/degrades')
+    def degrades():
+        try:
+            db.session.execute(text('SELECT 1'))
+            return jsonify({"database": "connected"}), 200
+        except Exception:
+            return jsonify({"database": "disconnected"}), 200
+
+    return app.test_client()
+
+
+@pytest.fixture
+def exhausted(monkeypatch):
+    def timeout(self):
+        raise PoolTimeoutError("QueuePool limit reached")
+    monkeypatch.setattr(QueuePool, '_do_get', timeout)
+
+
+@pytest.mark.parametrize('path', ['/catches', '/raises'])
+def test_checkout_timeout_is_503_even_when_the_route_catches_it(client, exhausted, path):
+    response = client.get(path)
+
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == '1'
+
+
+def test_routes_that_recover_keep_their_response(client, exhausted):
+    response = client.get('/degrades')
+
+    assert response.status_code == 200
+    assert response.get_json() == {"database": "disconnected"}
+
+
+def test_connections_are_served_normally(client):
+    assert client.get('/catches').status_code == 200
@@ -0,0 +1,162 @@
+import gzip
+from types import SimpleNamespace
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session as OrmSession
+import pytest
+
+from service_core import db, http
+
+
+@pytest.fixture
+def statements(session_service, auth_service):
+    """SQL statements run on either service's engine while the test runs."""
+    executed = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        executed.append(statement)
+
+    engines = []
+    for service in (session_service, auth_service):
+        with service.app.app_context():
+            engines.append(db.engine)
+    for engine in engines:
+        event.listen(engine, 'before_cursor_execute', record)
+    yield executed
+    for engine in engines:
+        event.remove(engine, 'before_cursor_execute', record)
+
+
+@pytest.fixture
+def game(session_service, session_client):
+    with session_service.app.app_context():
+        session = session_service.Session(gm_id=1, campaign_name="Lost Mine", status="active")
+        db.session.add(session)
+        db.session.flush()
+        db.session.add(session_service.Player(session_id=session.id, player_id=2, character_id=3))
+        db.session.commit()
+        return session.id
+
+
+@pytest.fixture
+def hero(auth_service, auth_client):
+    with auth_service.app.app_context():
+        owner = auth_service.User("gm", "gm@example.com", "secret")
+        other = auth_service.User("player", "player@example.com", "secret")
+        db.session.add_all([owner, other])
+        db.session.flush()
+        character = auth_service.Character(user_id=owner.id, character_name="Aria", character_class="Bard",
+                                           character_race="Elf", starting_stats={"cha": 16})
+        db.session.add(character)
+        db.session.commit()
+        return SimpleNamespace(user_id=owner.id, other_id=other.id, character_id=character.id)
+
+
+def revalidate(client, url):
+    """GET url, then GET it again with the ETag it returned."""
+    first = client.get(url)
+    assert first.status_code == 200
+    second = client.get(url, headers={'If-None-Match': first.headers['ETag']})
+    return first, second
+
+
+def test_unchanged_session_is_not_modified(session_client, game):
+    first, second = revalidate(session_client, f'/get_session/{game}')
+
+    assert first.headers['ETag'] == f'W/"session-{game}-1"'
+    assert second.status_code == 304
+    assert second.headers['ETag'] == first.headers['ETag']
+    assert second.get_data() == b''
+
+
+def test_unchanged_user_and_character_are_not_modified(auth_client, hero):
+    for url in (f'/auth/user/{hero.user_id}', f'/auth/character/{hero.character_id}'):
+        first, second = revalidate(auth_client, url)
+        assert second.status_code == 304
+        assert second.headers['ETag'] == first.headers['ETag']
+
+
+@pytest.mark.parametrize('change', ['npc', 'combat', 'end', 'transfer'])
+def test_session_etag_changes_with_every_write(session_client, game, change):
+    before = session_client.get(f'/get_session/{game}')
+
+    requests = {
+        'npc': (f'/session/{game}/npc/create', {"npc_name": "Goblin", "npc_stats": {"hp": 7}, "npc_role": "enemy"}),
+        'combat': (f'/session/{game}/combat/initiate', {"participants": [2]}),
+        'end': (f'/session/{game}/end', {"gm_id": 1}),
+        'transfer': ('/session/transfer-character',
+                     {"session_id": game, "old_player_id": 2, "new_player_id": 4, "character_id": 3}),
+    }
+    url, body = requests[change]
+    assert session_client.post(url, json=body).status_code in (200, 201)
+
+    after = session_client.get(f'/get_session/{game}', headers={'If-None-Match': before.headers['ETag']})
+    assert after.status_code == 200
+    assert after.headers['ETag'] == f'W/"session-{game}-2"'
+    assert after.get_json() != before.get_json()
+
+
+def test_character_etag_changes_after_a_transfer(auth_client, hero, cache):
+    before = auth_client.get(f'/auth/character/{hero.character_id}')  # Also fills the cache
+
+    response = auth_client.post('/auth/transfer-character', json={
+        "old_player_id": hero.user_id, "new_player_id": hero.other_id, "character_id": hero.character_id})
+    assert response.status_code == 200
+
+    after = auth_client.get(f'/auth/character/{hero.character_id}', headers={'If-None-Match': before.headers['ETag']})
+    assert after.status_code == 200
+    assert before.headers['ETag'] == f'W/"character-{hero.character_id}-1"'
+    assert after.headers['ETag'] == f'W/"character-{hero.character_id}-2"'
+
+
+def test_cache_hit_answers_304_without_the_database(auth_client, hero, statements):
+    for url in (f'/auth/user/{hero.user_id}', f'/auth/character/{hero.character_id}'):
+        tag = auth_client.get(url).headers['ETag']  # Fills the cache
+        statements.clear()
+
+        response = auth_client.get(url, headers={'If-None-Match': tag})
+
+        assert response.status_code == 304
+        assert statements == []
+
+
+def test_new_session_is_created_in_one_commit(session_service, session_client, monkeypatch):
+    # auth_service confirms every id
+    monkeypatch.setattr(session_service.requests, 'get', lambda *args, **kwargs: SimpleNamespace(status_code=200, headers={}))
+    commits = []
+
+    def record(session):
+        commits.append(session)
+
+    event.listen(OrmSession, 'after_commit', record)
+    try:
+        response = session_client.post('/session/init', json={
+            "gm_id": 1, "campaign_name": "Lost Mine", "players": [{"player_id": 2, "character_id": 3}]})
+    finally:
+        event.remove(OrmSession, 'after_commit', record)
+
+    assert response.status_code == 201
+    assert len(commits) == 1
+    session = session_client.get(f"/get_session/{response.get_json()['session_id']}")
+    assert session.get_json()['players'] == [{"player_id": 2, "character_id": 3}]
+
+
+def test_compresses_only_large_responses(session_service, session_client, monkeypatch):
+    monkeypatch.setattr(http, 'COMPRESS_MIN_SIZE', 1024)
+    with session_service.app.app_context():
+        for i in range(40):
+            db.session.add(session_service.Session(gm_id=1, campaign_name=f"Campaign {i}", status="active"))
+        db.session.commit()
+
+    small = session_client.get('/get_sessions?gm_id=1&status=active&fields=session_id', headers={'Accept-Encoding': 'gzip'})
+    large = session_client.get('/get_sessions?gm_id=1&status=active', headers={'Accept-Encoding': 'gzip'})
+    plain = session_client.get('/get_sessions?gm_id=1&status=active', headers={'Accept-Encoding': 'identity'})
+
+    assert len(small.get_data()) < 1024
+    assert 'Content-Encoding' not in small.headers
+    assert large.headers['Content-Encoding'] == 'gzip'
+    assert 'Content-Encoding' not in plain.headers
+    assert gzip.decompress(large.get_data()) == plain.get_data()
+    assert len(large.get_data()) < len(plain.get_data())
+    for response in (small, large, plain):
+        assert 'Accept-Encoding' in response.headers['Vary']
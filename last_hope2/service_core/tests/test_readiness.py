@@ -0,0 +1,43 @@
+import threading
+import time
+
+from flask import Flask
+
+from service_core import readiness
+from service_core.readiness import init_readiness, on_ready, start_warmup
+
+
+def test_concurrent_first_requests_warm_up_once(monkeypatch):
+    monkeypatch.setattr(readiness, 'READINESS_CHECKS', [])
+    app = Flask(__name__)
+    init_readiness(app, db=None)
+    calls = []
+    on_ready(app, calls.append)
+
+    barrier = threading.Barrier(8)
+
+    def first_request():
+        barrier.wait()
+        app.test_client().get('/ready')
+
+    threads = [threading.Thread(target=first_request) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    while app.extensions['readiness'].state != 'ready':
+        time.sleep(0.005)
+
+    assert start_warmup(app) is None
+    assert calls == [app]
+
+
+def test_callback_added_after_warm_up_runs_at_once(monkeypatch):
+    monkeypatch.setattr(readiness, 'READINESS_CHECKS', [])
+    app = Flask(__name__)
+    init_readiness(app, db=None)
+    start_warmup(app).join()
+
+    calls = []
+    on_ready(app, calls.append)
+    assert calls == [app]
@@ -0,0 +1,212 @@
+import fakeredis
+from prometheus_client import REGISTRY
+import pytest
+import redis
+
+from service_core import sharding
+from service_core.sharding import HashRing, NodeUnavailable, ShardedCache
+
+NODES = ['redis:6379', 'redis_2:6379', 'redis_3:6379']
+
+
+class CountingRedis(fakeredis.FakeRedis):
+    """In-memory node that counts the pipelines opened on it."""
+
+    def __init__(self, **kwargs):
+        super().__init__(server=fakeredis.FakeServer(), **kwargs)
+        self.pipelines = 0
+
+    def pipeline(self, *args, **kwargs):
+        self.pipelines += 1
+        return super().pipeline(*args, **kwargs)
+
+
+def node_down(client):
+    client.connection_pool.connection_kwargs['server'].connected = False
+
+
+def node_up(client):
+    client.connection_pool.connection_kwargs['server'].connected = True
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(sharding.time, 'monotonic', lambda: now[0])
+    return now
+
+
+def make_cache(nodes=NODES, with_replicas=False, **kwargs):
+    primaries = {name: CountingRedis() for name in nodes}
+    replicas = {name: CountingRedis() for name in nodes} if with_replicas else None
+    return ShardedCache(primaries, replicas, **kwargs), primaries, replicas
+
+
+def test_placement_is_stable_and_spread_over_nodes():
+    ring = HashRing()
+    for node in NODES:
+        ring.add_node(node)
+    other = HashRing()
+    for node in reversed(NODES):
+        other.add_node(node)
+
+    keys = [f"user:{i}" for i in range(6000)]
+    owners = [ring.get_node(key) for key in keys]
+    assert owners == [other.get_node(key) for key in keys]
+    for node in NODES:
+        assert 0.2 < owners.count(node) / len(keys) < 0.47
+
+
+def test_hash_tag_keeps_keys_together():
+    ring = HashRing()
+    for node in NODES:
+        ring.add_node(node)
+    owners = {ring.get_node(f"ratelimit:{{/get_sessions}}:{suffix}") for suffix in ('all', 'ip:1.2.3.4', 'user:7@1.2.3.4')}
+    assert owners == {ring.get_node('/get_sessions')}
+
+
+def test_adding_a_node_moves_about_one_nth_of_keys():
+    ring = HashRing()
+    for node in NODES:
+        ring.add_node(node)
+    keys = [f"character:{i}" for i in range(10000)]
+    before = {key: ring.get_node(key) for key in keys}
+
+    ring.add_node('redis_4:6379')
+    moved = [key for key in keys if ring.get_node(key) != before[key]]
+
+    assert 0.15 < len(moved) / len(keys) < 0.35
+    assert all(ring.get_node(key) == 'redis_4:6379' for key in moved)
+
+
+def test_removing_a_node_only_moves_its_keys():
+    ring = HashRing()
+    for node in NODES:
+        ring.add_node(node)
+    keys = [f"user:{i}" for i in range(3000)]
+    before = {key: ring.get_node(key) for key in keys}
+
+    ring.remove_node('redis_2:6379')
+
+    for key in keys:
+        if before[key] != 'redis_2:6379':
+            assert ring.get_node(key) == before[key]
+        else:
+            assert ring.get_node(key) != 'redis_2:6379'
+
+
+def test_values_live_on_the_owning_node():
+    cache, primaries, _ = make_cache()
+    cache.set('user:1', 'alice')
+
+    owner = cache.shard_for('user:1').name
+    assert cache.get('user:1') == b'alice'
+    for name, client in primaries.items():
+        assert (client.get('user:1') == b'alice') == (name == owner)
+
+
+def test_reads_fail_over_to_the_replica(clock):
+    cache, primaries, replicas = make_cache(with_replicas=True)
+    owner = cache.shard_for('user:1').name
+    primaries[owner].set('user:1', 'from-primary')
+    replicas[owner].set('user:1', 'from-replica')
+
+    node_down(primaries[owner])
+
+    assert cache.get('user:1') == b'from-replica'
+    assert cache.mget(['user:1']) == [b'from-replica']
+
+
+def test_reads_without_replica_miss_instead_of_failing(clock):
+    cache, primaries, _ = make_cache()
+    cache.set('user:1', 'alice')
+    node_down(primaries[cache.shard_for('user:1').name])
+
+    assert cache.get('user:1') is None
+
+
+def test_writes_to_a_down_node_are_dropped(clock):
+    cache, primaries, replicas = make_cache(with_replicas=True)
+    owner = cache.shard_for('user:1').name
+    node_down(primaries[owner])
+
+    assert cache.set('user:1', 'alice') is None
+    assert cache.delete('user:1') == 0
+    assert replicas[owner].get('user:1') is None  # Writes never go to the replica
+
+
+def test_failed_node_is_skipped_until_the_cooldown_ends(clock):
+    cache, primaries, _ = make_cache(down_cooldown=5.0)
+    owner = cache.shard_for('user:1').name
+    primaries[owner].set('user:1', 'alice')
+
+    node_down(primaries[owner])
+    assert cache.get('user:1') is None
+    node_up(primaries[owner])
+
+    clock[0] += 4.9
+    assert cache.get('user:1') is None  # Still cooling down, the primary isn't tried
+    clock[0] += 0.2
+    assert cache.get('user:1') == b'alice'
+    assert cache.shards[owner].available
+
+
+def test_up_gauge_follows_the_primary(clock):
+    cache, primaries, _ = make_cache(down_cooldown=5.0)
+    owner = cache.shard_for('user:1').name
+    up = lambda: REGISTRY.get_sample_value('cache_shard_up', {'shard': owner})
+
+    node_down(primaries[owner])
+    cache.get('user:1')
+    assert up() == 0
+
+    # A ping probes nodes that are still cooling down, and a success brings them back
+    node_up(primaries[owner])
+    cache.ping()
+    assert cache.shards[owner].available
+    assert up() == 1
+    cache.get('user:1')
+    assert up() == 1
+
+
+def test_mget_uses_one_pipeline_per_shard():
+    cache, primaries, _ = make_cache()
+    keys = [f"user:{i}" for i in range(30)]
+    for key in keys[::2]:
+        cache.set(key, key)
+
+    values = cache.mget(keys)
+
+    assert values == [key.encode() if i % 2 == 0 else None for i, key in enumerate(keys)]
+    shards_used = {cache.shard_for(key).name for key in keys}
+    assert len(shards_used) == len(NODES)
+    assert {name: client.pipelines for name, client in primaries.items()} == {name: 1 for name in NODES}
+
+
+def test_ping_fails_only_when_every_node_is_down(clock):
+    cache, primaries, _ = make_cache()
+    node_down(primaries[NODES[0]])
+    assert cache.ping()
+
+    for client in primaries.values():
+        node_down(client)
+    with pytest.raises(redis.exceptions.ConnectionError):
+        cache.ping()
+
+
+def test_script_runs_on_the_node_owning_its_keys(clock):
+    cache, primaries, replicas = make_cache(with_replicas=True)
+    script = cache.register_script("redis.call('SET', KEYS[1], ARGV[1]) return redis.call('INCR', KEYS[2])")
+    keys = ['bucket:{/auth}:all', 'bucket:{/auth}:count']
+    owner = cache.shard_for(keys[0]).name
+
+    assert script(keys=keys, args=['x']) == 1
+    assert script(keys=keys, args=['y']) == 2
+    for name, client in primaries.items():
+        assert (client.get(keys[0]) == b'y') == (name == owner)
+
+    # Scripts write, so a down primary is never replaced by its replica
+    node_down(primaries[owner])
+    with pytest.raises(NodeUnavailable):
+        script(keys=keys, args=['z'])
+    assert replicas[owner].get(keys[0]) is None
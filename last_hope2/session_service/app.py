@@ -1,18 +1,34 @@
-from flask import Flask, Blueprint, request, jsonify
-from flask_sqlalchemy import SQLAlchemy
+from flask import Blueprint, request, jsonify
+from sqlalchemy.orm import selectinload, load_only, defer
 from flask_socketio import SocketIO, join_room, send, emit
 from dotenv import load_dotenv
 import os
 from sqlalchemy.dialects.postgresql import JSON
-from prometheus_client import start_http_server, Counter,generate_latest
+from prometheus_client import start_http_server, Counter
 import requests
 from flask_cors import CORS
+from werkzeug.serving import is_running_from_reloader
+import threading
+import time
+import json
+import zlib
+from datetime import datetime
 
 load_dotenv()  # Load environment variables from .env
 
+from service_core import create_service_app, db, bump_revision, on_ready, start_warmup, indexed_filter_sets, requested_fields
+from service_core import etag_for, is_fresh, not_modified, with_etag, internal_headers
+
 request_counter = Counter('session_requests', 'Number of requests')
+archived_counter = Counter('session_archived_sessions', 'Number of ended sessions moved to the archive')
+
+# Archival job settings: ended sessions are moved out of the live tables in small
+# batches, with a pause between batches so the job never competes with live traffic
+ARCHIVE_ENABLED = os.getenv('ARCHIVE_ENABLED', 'true').lower() == 'true'
+ARCHIVE_BATCH_SIZE = int(os.getenv('ARCHIVE_BATCH_SIZE', '50'))
+ARCHIVE_BATCH_PAUSE = float(os.getenv('ARCHIVE_BATCH_PAUSE', '0.5'))  # seconds between batches
+ARCHIVE_INTERVAL = float(os.getenv('ARCHIVE_INTERVAL', '60'))  # seconds between runs
 
-db = SQLAlchemy()
 socketio = SocketIO()
 
 # Models
@@ -22,21 +38,30 @@ class Session(db.Model):
     gm_id = db.Column(db.Integer, nullable=False)
     campaign_name = db.Column(db.String(100), nullable=False)
     status = db.Column(db.String(50), default='active')
+    # Bumped by every route that changes the session or its players, npcs or combats
+    revision = db.Column(db.Integer, nullable=False, default=1, server_default=db.text('1'))
     players = db.relationship('Player', backref='session', cascade="all, delete")
     npcs = db.relationship('NPC', backref='session', cascade="all, delete")
     combats = db.relationship('Combat', backref='session', cascade="all, delete")
+    __table_args__ = (
+        db.Index('ix_sessions_status_gm_id', 'status', 'gm_id'),
+        db.Index('ix_sessions_gm_id_status', 'gm_id', 'status'),
+    )
 
 class Player(db.Model):
     __tablename__ = 'players'
     id = db.Column(db.Integer, primary_key=True)
-    session_id = db.Column(db.Integer, db.ForeignKey('sessions.id'), nullable=False)
+    session_id = db.Column(db.Integer, db.ForeignKey('sessions.id'), nullable=False, index=True)
     player_id = db.Column(db.Integer, nullable=False)
     character_id = db.Column(db.Integer, nullable=False)
+    __table_args__ = (
+        db.Index('ix_players_player_id_session_id', 'player_id', 'session_id'),
+    )
 
 class NPC(db.Model):
     __tablename__ = 'npcs'
     id = db.Column(db.Integer, primary_key=True)
-    session_id = db.Column(db.Integer, db.ForeignKey('sessions.id'), nullable=False)
+    session_id = db.Column(db.Integer, db.ForeignKey('sessions.id'), nullable=False, index=True)
     npc_name = db.Column(db.String(100), nullable=False)
     npc_stats = db.Column(db.JSON, nullable=False)
     npc_role = db.Column(db.String(50), nullable=False)
@@ -44,17 +69,64 @@ class NPC(db.Model):
 class Combat(db.Model):
     __tablename__ = 'combats'
     id = db.Column(db.Integer, primary_key=True)
-    session_id = db.Column(db.Integer, db.ForeignKey('sessions.id'), nullable=False)
+    session_id = db.Column(db.Integer, db.ForeignKey('sessions.id'), nullable=False, index=True)
     participants = db.Column(db.JSON, nullable=False)
 
+# Cold storage for ended sessions. The whole session (players, npcs, combats)
+# is kept as a single zlib-compressed JSON document, keyed by the original id.
+class ArchivedSession(db.Model):
+    __tablename__ = 'archived_sessions'
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    gm_id = db.Column(db.Integer, nullable=False, index=True)
+    campaign_name = db.Column(db.String(100), nullable=False)
+    archived_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    payload = db.Column(db.LargeBinary, nullable=False)
+
+    def to_dict(self):
+        return json.loads(zlib.decompress(self.payload))
+
+SESSION_COLUMNS = {"session_id": "id", "gm_id": "gm_id", "campaign_name": "campaign_name", "status": "status"}
+SESSION_RELATIONSHIPS = ("players", "npcs", "combats")
+SESSION_FIELDS = tuple(SESSION_COLUMNS) + SESSION_RELATIONSHIPS
+
+# Filter combinations /get_sessions accepts. Each tuple lists the filters one index can
+# seek on, left to right, so any leading part of a tuple is a supported combination.
+# player_id goes through ix_players_player_id_session_id and then the sessions primary key.
+SESSION_QUERY_INDEXES = [
+    ("status", "gm_id"),
+    ("gm_id", "status"),
+    ("player_id", "status"),
+]
+
+SESSION_FILTER_SETS = indexed_filter_sets(SESSION_QUERY_INDEXES)
+
+def serialize_session(session, fields=SESSION_FIELDS):
+    serializers = {
+        "session_id": lambda: session.id,
+        "gm_id": lambda: session.gm_id,
+        "campaign_name": lambda: session.campaign_name,
+        "status": lambda: session.status,
+        "players": lambda: [{"player_id": player.player_id, "character_id": player.character_id} for player in session.players],
+        "npcs": lambda: [{"npc_id": npc.id, "npc_name": npc.npc_name, "npc_stats": npc.npc_stats, "npc_role": npc.npc_role} for npc in session.npcs],
+        "combats": lambda: [{"combat_id": combat.id, "participants": combat.participants} for combat in session.combats]
+    }
+    return {field: serializers[field]() for field in fields}
+
+# Archived sessions in /get_sessions: the columns kept next to the payload are enough
+# for the plain fields, so the payload is only decompressed for players, npcs or combats
+def serialize_archived_session(archived, fields):
+    if any(field in SESSION_RELATIONSHIPS for field in fields):
+        data = archived.to_dict()
+    else:
+        data = {"session_id": archived.id, "gm_id": archived.gm_id,
+                "campaign_name": archived.campaign_name, "status": "ended"}
+    session_data = {field: data[field] for field in fields}
+    session_data["archived"] = True
+    return session_data
+
 session_routes = Blueprint('session_routes', __name__)
 CORS(session_routes)
 
-# Prometheus endpoint for Prometheus to scrape metrics
-@session_routes.route('/metrics')
-def metrics():
-    return generate_latest(), 200
-
 # Status endpoint
 @session_routes.route('/status', methods=['GET'])
 def status():
@@ -78,6 +150,18 @@ def status():
         "message": "Service is operational"
     }), 200
 
+# Turn a failed lookup in auth_service into this route's error response, or None if it succeeded.
+# Only a 404 means the entity doesn't exist; 429 and 503 mean auth_service is overloaded.
+def check_auth_response(response, not_found_error):
+    if response.status_code == 200:
+        return None
+    if response.status_code == 404:
+        return jsonify({"error": not_found_error}), 404
+    if response.status_code in (429, 503):
+        retry_after = response.headers.get('Retry-After', '1')
+        return jsonify({"error": "Authentication service is busy, try again later"}), 503, {'Retry-After': retry_after}
+    return jsonify({"error": "Unexpected response from the authentication service", "status": response.status_code}), 502
+
 # Initialize a game session
 @session_routes.route('/session/init', methods=['POST'])
 def initialize_session():
@@ -95,9 +179,10 @@ def initialize_session():
     # Communicate with the other service to validate gm_id and player details
     try:
         # Validate GM ID
-        gm_response = requests.get(f'http://auth_service:5000/auth/user/{gm_id}')
-        if gm_response.status_code != 200:
-            return jsonify({"error": "Invalid GM ID"}), 404
+        gm_response = requests.get(f'http://auth_service:5000/auth/user/{gm_id}', headers=internal_headers('session_service'))
+        error = check_auth_response(gm_response, "Invalid GM ID")
+        if error:
+            return error
 
         # Validate each player in the `players` list
         for player in players:
@@ -105,14 +190,16 @@ def initialize_session():
             character_id = player["character_id"]
 
             # Check if player exists in the User table
-            player_response = requests.get(f'http://auth_service:5000/auth/user/{player_id}')
-            if player_response.status_code != 200:
-                return jsonify({"error": f"Invalid player ID {player_id}"}), 404
+            player_response = requests.get(f'http://auth_service:5000/auth/user/{player_id}', headers=internal_headers('session_service'))
+            error = check_auth_response(player_response, f"Invalid player ID {player_id}")
+            if error:
+                return error
 
             # Check if character exists in the Character table
-            character_response = requests.get(f'http://auth_service:5000/auth/character/{character_id}')
-            if character_response.status_code != 200:
-                return jsonify({"error": f"Invalid character ID {character_id} for player {player_id}"}), 404
+            character_response = requests.get(f'http://auth_service:5000/auth/character/{character_id}', headers=internal_headers('session_service'))
+            error = check_auth_response(character_response, f"Invalid character ID {character_id} for player {player_id}")
+            if error:
+                return error
 
     except requests.exceptions.RequestException as e:
         print(e)
@@ -125,9 +212,10 @@ def initialize_session():
         status="active"
     )
     db.session.add(session)
-    db.session.commit()
+    db.session.flush()  # Assigns session.id without committing
 
-    # Add players to the session
+    # Add players to the session, in the same commit, so the session is never visible
+    # without them under its first revision
     for player in players:
         player_obj = Player(session_id=session.id, player_id=player["player_id"], character_id=player["character_id"])
         db.session.add(player_obj)
@@ -152,6 +240,7 @@ def create_npc(session_id):
         npc_role=data["npc_role"]
     )
     db.session.add(npc)
+    bump_revision(Session, session_id)
     db.session.commit()
 
     return jsonify({"npc_id": npc.id, "message": "NPC created successfully"}), 201
@@ -167,6 +256,7 @@ def initiate_combat(session_id):
 
     combat = Combat(session_id=session_id, participants=data["participants"])
     db.session.add(combat)
+    bump_revision(Session, session_id)
     db.session.commit()
 
     return jsonify({"combat_id": combat.id, "message": "Combat initiated"}), 201
@@ -183,6 +273,7 @@ def end_session(session_id):
     session = Session.query.get(session_id)
     if session:
         session.status = "ended"
+        bump_revision(Session, session_id)
         db.session.commit()
         return jsonify({"message": "Game session ended"}), 200
     else:
@@ -191,37 +282,82 @@ def end_session(session_id):
 @session_routes.route('/get_session/<int:session_id>', methods=['GET'])
 def get_session(session_id):
     request_counter.inc()
+
+    # Conditional GET: answer from the revision alone, without loading players, npcs or combats
+    if request.if_none_match:
+        revision = db.session.query(Session.revision).filter_by(id=session_id).scalar()
+        if revision is not None and is_fresh(etag_for("session", session_id, revision)):
+            return not_modified(etag_for("session", session_id, revision))
+
     session = Session.query.get(session_id)
     if session:
-        session_data = {
-            "session_id": session.id,
-            "gm_id": session.gm_id,
-            "campaign_name": session.campaign_name,
-            "status": session.status,
-            "players": [{"player_id": player.player_id, "character_id": player.character_id} for player in session.players],
-            "npcs": [{"npc_id": npc.id, "npc_name": npc.npc_name, "npc_stats": npc.npc_stats, "npc_role": npc.npc_role} for npc in session.npcs],
-            "combats": [{"combat_id": combat.id, "participants": combat.participants} for combat in session.combats]
-        }
-        return jsonify(session_data), 200
-    else:
-        return jsonify({"error": "Session not found"}), 404
+        return with_etag(jsonify(serialize_session(session)), etag_for("session", session.id, session.revision)), 200
+
+    # Slow path: the session may have ended and been moved to the archive.
+    # Archived sessions never change, so they share one fixed revision.
+    archived_tag = etag_for("session", session_id, "archived")
+    if request.if_none_match and is_fresh(archived_tag):
+        if db.session.query(ArchivedSession.id).filter_by(id=session_id).scalar() is not None:
+            return not_modified(archived_tag)
+
+    archived = ArchivedSession.query.get(session_id)
+    if archived:
+        session_data = archived.to_dict()
+        session_data["archived"] = True
+        return with_etag(jsonify(session_data), archived_tag), 200
+
+    return jsonify({"error": "Session not found"}), 404
     
 
 @session_routes.route('/get_sessions', methods=['GET'])
 def get_sessions():
     request_counter.inc()
-    sessions = Session.query.all()
-    session_data = []
-    for session in sessions:
-        session_data.append({
-            "session_id": session.id,
-            "gm_id": session.gm_id,
-            "campaign_name": session.campaign_name,
-            "status": session.status,
-            "players": [{"player_id": player.player_id, "character_id": player.character_id} for player in session.players],
-            "npcs": [{"npc_id": npc.id, "npc_name": npc.npc_name, "npc_stats": npc.npc_stats, "npc_role": npc.npc_role} for npc in session.npcs],
-            "combats": [{"combat_id": combat.id, "participants": combat.participants} for combat in session.combats]
-        })
+    filters = {}
+    for name in ("gm_id", "player_id"):
+        if name in request.args:
+            value = request.args.get(name, type=int)
+            if value is None:
+                return jsonify({"error": f"'{name}' must be an integer"}), 400
+            filters[name] = value
+    if "status" in request.args:
+        filters["status"] = request.args["status"]
+
+    # Query-cost guard: only combinations served by an index are accepted
+    if filters and frozenset(filters) not in SESSION_FILTER_SETS:
+        supported = sorted(", ".join(sorted(combo)) for combo in SESSION_FILTER_SETS)
+        return jsonify({"error": "Unsupported filter combination", "supported_filters": supported}), 400
+
+    fields, error = requested_fields(SESSION_FIELDS)
+    if error:
+        return jsonify({"error": error}), 400
+
+    query = Session.query
+    if "player_id" in filters:
+        query = query.filter(Session.id.in_(
+            db.session.query(Player.session_id).filter(Player.player_id == filters["player_id"])))
+    if "gm_id" in filters:
+        query = query.filter(Session.gm_id == filters["gm_id"])
+    if "status" in filters:
+        query = query.filter(Session.status == filters["status"])
+
+    # Only load the columns and child tables the caller asked for
+    columns = [getattr(Session, SESSION_COLUMNS[field]) for field in fields if field in SESSION_COLUMNS]
+    query = query.options(load_only(Session.id, *columns))
+    for relationship in SESSION_RELATIONSHIPS:
+        if relationship in fields:
+            query = query.options(selectinload(getattr(Session, relationship)))
+
+    sessions = [(session.id, serialize_session(session, fields)) for session in query.order_by(Session.id)]
+
+    # Ended sessions move to the archive, which can only be searched by gm_id
+    if "gm_id" in filters and "player_id" not in filters and filters.get("status", "ended") == "ended":
+        archived_query = ArchivedSession.query.filter_by(gm_id=filters["gm_id"])
+        if not any(field in SESSION_RELATIONSHIPS for field in fields):
+            archived_query = archived_query.options(defer(ArchivedSession.payload))
+        sessions += [(archived.id, serialize_archived_session(archived, fields)) for archived in archived_query]
+        sessions.sort(key=lambda item: item[0])
+
+    session_data = [data for _, data in sessions]
 
     return jsonify(session_data), 200
 
@@ -266,23 +402,79 @@ def transfer_character():
             return jsonify({"error": "Player or character not found in session"}), 404
 
         player.player_id = new_player_id
+        bump_revision(Session, session_id)
         db.session.commit()
-        
 
         return jsonify({"message": "Character ownership transferred successfully"}), 200
 
     except Exception as e:
         print(f"Error occurred in session_service: {e}")
-        #db.session.rollback()  # Roll back changes if something fails
-        player.player_id = old_player_id
-        db.session.commit()
+        db.session.rollback()  # Roll back changes if something fails
 
         return jsonify({"error": "Transaction failed", "details": str(e)}), 500
 
     
 
+#=============================================================================================
+# Archival of ended sessions
+
+def archive_ended_sessions(batch_size=ARCHIVE_BATCH_SIZE, pause=ARCHIVE_BATCH_PAUSE):
+    archived = 0
+    while True:
+        query = Session.query.filter_by(status="ended").order_by(Session.id).limit(batch_size).options(
+            selectinload(Session.players), selectinload(Session.npcs), selectinload(Session.combats))
+        if db.engine.dialect.name == 'postgresql':
+            # Let several replicas run the job at once without archiving the same rows
+            query = query.with_for_update(skip_locked=True, of=Session)
+        sessions = query.all()
+        if not sessions:
+            break
+
+        session_ids = [session.id for session in sessions]
+        for session in sessions:
+            db.session.add(ArchivedSession(
+                id=session.id,
+                gm_id=session.gm_id,
+                campaign_name=session.campaign_name,
+                payload=zlib.compress(json.dumps(serialize_session(session)).encode())
+            ))
+
+        Player.query.filter(Player.session_id.in_(session_ids)).delete(synchronize_session=False)
+        NPC.query.filter(NPC.session_id.in_(session_ids)).delete(synchronize_session=False)
+        Combat.query.filter(Combat.session_id.in_(session_ids)).delete(synchronize_session=False)
+        Session.query.filter(Session.id.in_(session_ids)).delete(synchronize_session=False)
+        db.session.commit()
+
+        archived += len(session_ids)
+        archived_counter.inc(len(session_ids))
+        if len(session_ids) < batch_size:
+            break
+        time.sleep(pause)  # Throttle so live requests keep the database to themselves
+
+    return archived
+
+def start_archiver(app):
+    def run():
+        while True:
+            time.sleep(ARCHIVE_INTERVAL)
+            with app.app_context():
+                try:
+                    count = archive_ended_sessions()
+                    if count:
+                        print(f"Archived {count} ended sessions", flush=True)
+                except Exception as e:
+                    db.session.rollback()
+                    print(f"Error occurred while archiving sessions: {e}", flush=True)
+
+    threading.Thread(target=run, name="session-archiver", daemon=True).start()
+
 #=============================================================================================
 # WebSocket Events
+
+# Only players of active sessions can join a session room
+def active_player(user_id):
+    return Player.query.join(Session).filter(Player.player_id == user_id, Session.status == "active").first()
+
 @socketio.on('connect')
 def handle_connect():
     user_id = request.args.get('user_id')
@@ -290,7 +482,7 @@ def handle_connect():
         emit('error', {'msg': 'User ID required'})
         return
 
-    player = Player.query.filter_by(player_id=user_id).first()
+    player = active_player(user_id)
     if not player:
         emit('error', {'msg': 'Player not found'})
         return
@@ -320,7 +512,7 @@ def handle_message(data):
 @socketio.on('subscribe')
 def handle_subscribe(data):
     user_id = request.args.get('user_id')
-    player = Player.query.filter_by(player_id=user_id).first()
+    player = active_player(user_id)
     if not player:
         emit('error', {'msg': 'Player not found'})
         return
@@ -340,21 +532,11 @@ def notify_combat_started(session_id, combat_id):
 
 # Create the Flask app and integrate with SocketIO
 def create_app():
-    app = Flask(__name__)
-
-    # Load configuration
-    app.config['SECRET_KEY'] = os.getenv('SECRET_KEY')
-    app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('DATABASE_URL')
-
-    # Initialize extensions
-    db.init_app(app)
+    app = create_service_app(__name__, [session_routes])
     socketio.init_app(app)  # Initialize SocketIO
 
-    # Register Blueprints
-    app.register_blueprint(session_routes)
-
-    with app.app_context():
-        db.create_all()
+    if ARCHIVE_ENABLED:
+        on_ready(app, start_archiver)
 
     return app
 
@@ -365,7 +547,11 @@ app = create_app()
 
 # Run both Flask and WebSocket server
 if __name__ == "__main__":
-    socketio.run(app, host="0.0.0.0", port=5001, debug=True,allow_unsafe_werkzeug=True)
+    debug = True
+    # With debug on, the reloader runs this file again in a child process and only that one serves requests
+    if not debug or is_running_from_reloader():
+        start_warmup(app)
+    socketio.run(app, host="0.0.0.0", port=5001, debug=debug,allow_unsafe_werkzeug=True)
 
     # Start a separate HTTP server for Prometheus metrics on port 8000
-    start_http_server(8001)
\ No newline at end of file
+    start_http_server(8001)